@@ -2,8 +2,9 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2TokenizerFast, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
@@ -12,7 +13,6 @@ import argparse
 import json
 import numpy as np
 from typing import Tuple, Optional, Union
-import copy
 import time
 
 class MappingType(Enum):
@@ -20,63 +20,92 @@ class MappingType(Enum):
     Transformer = 'transformer'
 
 
+def token_cache_path(data_path: str) -> str:
+    return os.path.splitext(data_path)[0] + '_tokens.npz'
+
+
+def load_token_cache(data_path: str, gpt2_type: str) -> Optional[dict]:
+    # the cache is only valid for the same .pkl (by mtime) and the same tokenizer
+    cache_path = token_cache_path(data_path)
+    if not os.path.isfile(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if float(cache['mtime']) != os.path.getmtime(data_path) or str(cache['gpt2_type']) != gpt2_type:
+            return None
+        print('loading tokens from ' + cache_path)
+        return {key: cache[key] for key in cache.files}
+
+
+def save_token_cache(data_path: str, gpt2_type: str, **arrays):
+    np.savez(token_cache_path(data_path), mtime=os.path.getmtime(data_path), gpt2_type=gpt2_type, **arrays)
+
+
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
+        return len(self.tokens)
 
     def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+        # unpadded caption , padding and mask are built per batch in collate
+        return self.tokens[item, :self.lengths[item]]
+
+    def collate(self, batch):
+        # pads only up to the longest caption of the batch (rounded up to a multiple of 8 , so a compiled model
+        # sees a handful of shapes) instead of the global max_seq_len
+        lengths = torch.tensor([tokens.shape[0] for tokens, _ in batch])
+        batch_len = min(-(-int(lengths.max()) // 8) * 8, self.max_seq_len)
+        tokens = pad_sequence([tokens for tokens, _ in batch], batch_first=True, padding_value=0)
+        tokens = nnf.pad(tokens, (0, batch_len - tokens.shape[1]))
+        # the prefix positions are always below prefix_length + length , so one comparison builds the prefix
+        # ones and the caption mask together without a torch.cat , zero where we out of sequence
+        mask = (torch.arange(self.prefix_length + batch_len) < (lengths + self.prefix_length).unsqueeze(1)).float()
+        prefix = torch.stack([prefix for _, prefix in batch])
+        return tokens, mask, prefix
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
-        tokens, mask = self.pad_tokens(item)
+        tokens = self.pad_tokens(item)
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
 
-        # tokenized caption, mask attention , (prefix --> actual image)
-        return tokens, mask, prefix
+        # tokenized caption , (prefix --> actual image) , the mask attention is added in collate
+        return tokens, prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained(gpt2_type)
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(gpt2_type)
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
             all_data = pickle.load(f)
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
-        self.prefixes = all_data["clip_embedding"]
+        self.prefixes = all_data["clip_embedding"].contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            prefixes = self.prefixes.float()
+            self.prefixes = prefixes / prefixes.norm(2, dim=-1, keepdim=True)
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.captions = [caption['caption'] for caption in captions_raw]
-        self.captions_tokens = []
-        self.caption2embedding = []
-        max_seq_len = 0
-        for caption in captions_raw:
-            # tokenize to caption
-            self.captions_tokens.append(torch.tensor(self.tokenizer.encode(caption['caption']), dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+        # clip_embedding einai to sequential ID !!
+        self.caption2embedding = [caption["clip_embedding"] for caption in captions_raw]
+
+        cache = load_token_cache(data_path, gpt2_type)
+        if cache is not None:
+            # same arrays as the train_MTL_IC_VQA IC cache , either script can reuse the other's file
+            self.tokens, self.lengths = torch.from_numpy(cache['tokens']), torch.from_numpy(cache['captions_len'])
+        else:
+            # tokenize all captions in one batched call of the fast (rust) tokenizer , lengths come with it
+            encoded = self.tokenizer(self.captions, add_special_tokens=False, return_length=True)
+            all_len = torch.tensor(encoded['length']).float()
+            max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+            self.lengths = all_len.long().clamp_max(max_seq_len)
+            self.tokens = torch.zeros((len(all_len), max_seq_len), dtype=torch.int64)
+            for i, tokens in enumerate(encoded['input_ids']):
+                self.tokens[i, :self.lengths[i]] = torch.tensor(tokens[:max_seq_len], dtype=torch.int64)
+            save_token_cache(data_path, gpt2_type, tokens=self.tokens.numpy(), captions_len=self.lengths.numpy(),
+                             max_seq_len=max_seq_len)
+        self.max_seq_len = self.tokens.shape[1]
         print('max_seq_len of tokens :  ' + str(self.max_seq_len))
 
 
@@ -120,27 +149,74 @@ class MultiHeadAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim_self // num_heads
         self.scale = head_dim ** -0.5
-        self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
-        self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
+        self.fused_qkv = dim_ref == dim_self
+        if self.fused_qkv:
+            # one gemm for queries , keys and values , the state_dict keeps the to_queries / to_keys_values
+            # layout so checkpoints stay interchangeable with the other scripts
+            self.to_qkv = nn.Linear(dim_self, dim_self * 3, bias=bias)
+            self._register_state_dict_hook(MultiHeadAttention._split_qkv)
+            self._register_load_state_dict_pre_hook(MultiHeadAttention._merge_qkv)
+        else:
+            self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
+            self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
-        y = y if y is not None else x
+    @staticmethod
+    def _split_qkv(module, state_dict, prefix, local_metadata):
+        dim_self = module.to_qkv.out_features // 3
+        for name in ('weight', 'bias'):
+            qkv = state_dict.pop(prefix + 'to_qkv.' + name, None)
+            if qkv is not None:
+                state_dict[prefix + 'to_queries.' + name] = qkv[:dim_self]
+                state_dict[prefix + 'to_keys_values.' + name] = qkv[dim_self:]
+
+    @staticmethod
+    def _merge_qkv(state_dict, prefix, *args):
+        for name in ('weight', 'bias'):
+            q_key, kv_key = prefix + 'to_queries.' + name, prefix + 'to_keys_values.' + name
+            if q_key in state_dict and kv_key in state_dict:
+                state_dict[prefix + 'to_qkv.' + name] = torch.cat((state_dict.pop(q_key), state_dict.pop(kv_key)))
+
+    def forward(self, x, y=None, mask=None, need_weights=False):
         b, n, c = x.shape
-        _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
-        # b m 2 h dh
-        keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if self.fused_qkv and y is None:
+            # b n 3 h dh
+            queries, keys, values = self.to_qkv(x).reshape(b, n, 3, self.num_heads, c // self.num_heads).unbind(2)
+        else:
+            y = y if y is not None else x
+            _, m, d = y.shape
+            if self.fused_qkv:
+                bias = self.to_qkv.bias
+                queries = nnf.linear(x, self.to_qkv.weight[:c], None if bias is None else bias[:c])
+                keys_values = nnf.linear(y, self.to_qkv.weight[c:], None if bias is None else bias[c:])
+            else:
+                queries, keys_values = self.to_queries(x), self.to_keys_values(y)
+            # b n h dh
+            queries = queries.reshape(b, n, self.num_heads, c // self.num_heads)
+            # b m 2 h dh
+            keys_values = keys_values.reshape(b, m, 2, self.num_heads, c // self.num_heads)
+            keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
+        # b h n dh / b h m dh , head major so both paths below run batched gemms
+        queries, keys, values = queries.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2)
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
-            attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
-        attention = attention.softmax(dim=2)
-        out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
+            # b 1 n m , True where masked out
+            mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient) , the attention matrix is never materialized
+            out = nnf.scaled_dot_product_attention(queries, keys, values,
+                                                   attn_mask=None if mask is None else ~mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        # b h n m
+        attention = (queries @ keys.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            attention = attention.masked_fill(mask, float("-inf"))
+        attention = attention.softmax(dim=-1)
+        out = (attention @ values).transpose(1, 2).reshape(b, n, c)
         out = self.project(out)
         return out, attention
 
@@ -148,7 +224,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -271,6 +347,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , no weight gradients are computed for it in backward
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -302,13 +384,13 @@ def load_model(config_path: str, epoch_or_latest: Union[str, int] = '_latest'):
     return model, parser
 
 
-def apply_validation(model, val_dataloader, epoch, prefix_length):
+def apply_validation(model, val_dataloader, epoch, prefix_length, amp_dtype=torch.bfloat16):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     val_loss = 0
     model.eval()
     for idx, (tokens, mask, prefix) in enumerate(val_dataloader):
         tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
-        with torch.no_grad():
+        with torch.no_grad(), torch.autocast('cuda', dtype=amp_dtype):
             outputs = model(tokens, prefix, mask)
             logits = outputs.logits[:, prefix_length - 1: -1]
             loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
@@ -343,17 +425,30 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         os.makedirs(output_dir)
 
     model = model.to(device)
-    optimizer = AdamW(model.parameters(), lr=lr)
+    if myconfig.get('compile'):
+        # in-place, so the saved state_dict keys stay the same ; collate rounds the batch length up to a
+        # multiple of 8 , so only a handful of static shapes (and cuda graphs) are recorded
+        model.compile(mode='reduce-overhead', dynamic=False)
+    # single fused cuda kernel for the whole update over the trainable (mapping) params only ,
+    # weight_decay=0 as in the transformers AdamW
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, weight_decay=0.0,
+                                  fused=True)
     batch_size = myconfig.get('batch_size')
     epochs = myconfig.get('epochs')
 
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
+    num_workers = myconfig.get('num_workers', 0)
+    loader_kwargs = dict(batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers,
+                         pin_memory=True, persistent_workers=num_workers > 0)
+    train_dataloader = DataLoader(train_dataset, collate_fn=train_dataset.collate, **loader_kwargs)
+    val_dataloader = DataLoader(val_dataset, collate_fn=val_dataset.collate, **loader_kwargs)
 
     # earlystop = EarlyStopping(tolerance=5,delta=0.5)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
     )
+    # bf16 needs no loss scaling , the scaler only kicks in on fp16-only gpus
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
     avg_train_loss = []
     avg_val_loss = []
     max_val_loss = float('+inf')
@@ -363,21 +458,21 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
     for epoch in range(epochs):
         progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
         train_loss = 0
-        for idx, (tokens, mask, prefix) in enumerate(train_dataloader):
+        for idx, (tokens, mask, prefix) in enumerate(progress):
             model.train()
-            model.zero_grad()
             tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
 
-            outputs = model(tokens, prefix, mask)
-            logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
-            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
+            with torch.autocast('cuda', dtype=amp_dtype):
+                outputs = model(tokens, prefix, mask)
+                logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
+                loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
             train_loss = train_loss + loss.item()
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             progress.set_postfix({"Batch Train Loss": loss.item()})
-            progress.update()
 
         progress.close()
 
@@ -385,7 +480,8 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         avg_train_loss.append(epoch_avg_train_loss)
         print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
 
-        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, prefix_length=val_dataset.prefix_length)
+        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, prefix_length=val_dataset.prefix_length,
+                                              amp_dtype=amp_dtype)
         avg_val_loss.append(epoch_avg_val_loss)
 
         # earlystop(epoch_avg_train_loss,epoch_avg_val_loss)
@@ -394,10 +490,11 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         #     break
 
         if epoch_avg_val_loss < max_val_loss:
-            best_model = copy.deepcopy(model)
             max_val_loss = epoch_avg_val_loss
 
-            torch.save(best_model.state_dict(), os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
+            # a cpu copy of the weights is all that is saved , no deepcopy of the whole module
+            best_state = {k: v.detach().cpu().clone() for k, v in model.state_dict().items()}
+            torch.save(best_state, os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
             print(f'Best Validation loss  : {epoch_avg_val_loss}')
 
         if epoch % myconfig.get('save_every') == 0 or epoch == epochs - 1:
@@ -427,6 +524,7 @@ def generate_topk(
     eos_token_index = tokenizer.eos_token_id
     seq_lengths = torch.ones(batch_size, device=device)
     is_stopped = torch.zeros(batch_size, device=device, dtype=torch.bool)
+    stop_set = torch.tensor([stop_token_index, eos_token_index], device=device)
     with torch.no_grad():
         for entry_idx in range(entry_count):
             if embed is not None:
@@ -437,30 +535,30 @@ def generate_topk(
                     tokens = tokens.unsqueeze(0).to(device)
 
                 generated = model.gpt.transformer.wte(tokens)
+            past = None
             for i in range(entry_length):
-                outputs = model.gpt(inputs_embeds=generated)
-                logits = outputs.logits
-                logits = logits[:, -1, :] / (temperature if temperature > 0 else 1.0)
-                logits = logits.softmax(-1).log()
-                scores, next_tokens = logits.topk(1, -1)
+                # after the first step only the newest token is fed , keys/values come from the cache
+                outputs = model.gpt(inputs_embeds=generated, past_key_values=past, use_cache=True)
+                past = outputs.past_key_values
+                # greedy , softmax/log/temperature are monotone so the argmax of the raw logits is enough
+                next_tokens = outputs.logits[:, -1, :].argmax(-1, keepdim=True)
                 if tokens is None:
                     tokens = next_tokens
                 else:
                     tokens = torch.cat((tokens, next_tokens), dim=1)
-                next_token_embed = model.gpt.transformer.wte(next_tokens)
-                generated = torch.cat((generated, next_token_embed), dim=1)
+                generated = model.gpt.transformer.wte(next_tokens)
 
-                seq_lengths[~is_stopped] += 1
-                is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze() + \
-                             next_tokens.eq(eos_token_index).squeeze()
-                if is_stopped.all():
+                # arithmetic instead of a boolean index , which would run nonzero and sync every step
+                seq_lengths += (~is_stopped).to(seq_lengths.dtype)
+                is_stopped |= (next_tokens == stop_set).any(-1)
+                # .all() syncs with the host , poll it only every 4 steps
+                if i % 4 == 0 and is_stopped.all():
                     break
 
             output_list = tokens.cpu().numpy()
-            output_texts = [
-                tokenizer.decode(output[: int(length)], skip_special_tokens=True)
-                for output, length in zip(output_list, seq_lengths)
-            ]
+            trimmed = [output[: int(length)] for output, length in zip(output_list, seq_lengths.tolist())]
+            # one call into the rust decoder for the whole batch
+            output_texts = tokenizer.batch_decode(trimmed, skip_special_tokens=True)
     return output_texts
 
 
@@ -481,14 +579,16 @@ def group_reference_captions(gt_image_ids, gt_captions):
     return temp_dict
 
 
-def validation_generation(model, val_dataset, batch_size, weights_path=None):
+def validation_generation(model, val_dataset, batch_size, weights_path=None, num_workers=4):
     start_time = time.time()
     full_gt_dict = {}
     gen = {}
     gts = {}
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False,
+                                collate_fn=val_dataset.collate, num_workers=num_workers, pin_memory=True)
+    # the dataset already holds the fast tokenizer , no second load
+    tokenizer = val_dataset.tokenizer
     generated_captions = []
 
     gt_image_ids = val_dataset.image_ids
@@ -543,7 +643,9 @@ def main():
         'is_rn': False,
         'normalize_prefix': False,
         'model_name': 'my_coco_ic_model',
-        'weights_path': ''
+        'weights_path': '',
+        'compile': True,
+        'num_workers': 4
 
     }
     print('Logging args **** ' + str(myconfig))
@@ -559,7 +661,8 @@ def main():
                               mapping_type=mapping_type)
 
     gen, gts, full_gt_dict = validation_generation(model, val_dataset, batch_size=64,
-                                                   weights_path=myconfig.get('weights_path'))
+                                                   weights_path=myconfig.get('weights_path'),
+                                                   num_workers=myconfig.get('num_workers'))
 
 
 if __name__ == '__main__':
@@ -2,14 +2,17 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2Tokenizer, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
 import sys
 import argparse
 import json
+import gc
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Optional, Union
 import skimage.io as io
 import PIL.Image
@@ -28,29 +31,15 @@ class MappingType(Enum):
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
+        return len(self.tokens)
 
     def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+        # tokens and mask are precomputed in __init__
+        return self.tokens[item], self.mask[item]
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
         tokens, mask = self.pad_tokens(item)
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
         return tokens, mask, prefix
 
     def __init__(self, data_path: str,  prefix_length: int, gpt2_type: str = "gpt2",
@@ -68,6 +57,13 @@ class ClipCocoDataset(Dataset):
         # print('all_data["clip_embedding"]')
         print()
         self.prefixes = all_data["clip_embedding"]
+        if not torch.is_tensor(self.prefixes):
+            # one contiguous (N, prefix_size) tensor , rows are gathered in C
+            self.prefixes = torch.stack([torch.as_tensor(prefix) for prefix in self.prefixes])
+        self.prefixes = self.prefixes.float().contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            self.prefixes = self.prefixes / self.prefixes.norm(2, dim=-1, keepdim=True)
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
@@ -88,8 +84,14 @@ class ClipCocoDataset(Dataset):
             # self.max_seq_len = max_seq_len
             with open(f"{data_path[:-4]}_tokens.pkl", 'wb') as f:
                 pickle.dump([self.captions_tokens, self.caption2embedding, max_seq_len], f)
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
+        lengths = torch.tensor([len(tokens) for tokens in self.captions_tokens])
+        all_len = lengths.float()
         self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+        # one zero padded (N, max_seq_len) tensor instead of padding / truncating every item on access
+        self.tokens = pad_sequence(self.captions_tokens, batch_first=True, padding_value=0)[:, :self.max_seq_len]
+        mask = torch.arange(self.max_seq_len) < lengths.unsqueeze(1)  # mask is zero where we out of sequence
+        prefix_ones = torch.ones(len(self.tokens), self.prefix_length)
+        self.mask = torch.cat((prefix_ones, mask.float()), dim=1)  # adding prefix mask
 
 
 class MLP(nn.Module):
@@ -131,24 +133,67 @@ class MultiHeadAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim_self // num_heads
         self.scale = head_dim ** -0.5
-        self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
-        self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
+        self.fused_qkv = dim_ref == dim_self
+        if self.fused_qkv:
+            # one gemm for queries , keys and values , the state_dict keeps the to_queries / to_keys_values
+            # layout so checkpoints stay interchangeable with the other scripts
+            self.to_qkv = nn.Linear(dim_self, dim_self * 3, bias=bias)
+            self._register_state_dict_hook(MultiHeadAttention._split_qkv)
+            self._register_load_state_dict_pre_hook(MultiHeadAttention._merge_qkv)
+        else:
+            self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
+            self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
-        y = y if y is not None else x
+    @staticmethod
+    def _split_qkv(module, state_dict, prefix, local_metadata):
+        dim_self = module.to_qkv.out_features // 3
+        for name in ('weight', 'bias'):
+            qkv = state_dict.pop(prefix + 'to_qkv.' + name, None)
+            if qkv is not None:
+                state_dict[prefix + 'to_queries.' + name] = qkv[:dim_self]
+                state_dict[prefix + 'to_keys_values.' + name] = qkv[dim_self:]
+
+    @staticmethod
+    def _merge_qkv(state_dict, prefix, *args):
+        for name in ('weight', 'bias'):
+            q_key, kv_key = prefix + 'to_queries.' + name, prefix + 'to_keys_values.' + name
+            if q_key in state_dict and kv_key in state_dict:
+                state_dict[prefix + 'to_qkv.' + name] = torch.cat((state_dict.pop(q_key), state_dict.pop(kv_key)))
+
+    def forward(self, x, y=None, mask=None, need_weights=False):
         b, n, c = x.shape
-        _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
-        # b m 2 h dh
-        keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if self.fused_qkv and (y is None or y is x):
+            # b n 3 h dh
+            queries, keys, values = self.to_qkv(x).reshape(b, n, 3, self.num_heads, c // self.num_heads).unbind(2)
+        else:
+            y = y if y is not None else x
+            _, m, d = y.shape
+            if self.fused_qkv:
+                bias = self.to_qkv.bias
+                queries = nnf.linear(x, self.to_qkv.weight[:c], None if bias is None else bias[:c])
+                keys_values = nnf.linear(y, self.to_qkv.weight[c:], None if bias is None else bias[c:])
+            else:
+                queries, keys_values = self.to_queries(x), self.to_keys_values(y)
+            # b n h dh
+            queries = queries.reshape(b, n, self.num_heads, c // self.num_heads)
+            # b m 2 h dh
+            keys_values = keys_values.reshape(b, m, 2, self.num_heads, c // self.num_heads)
+            keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient) on b h n dh , the attention matrix is never materialized
+            attn_mask = None if mask is None else ~mask.unsqueeze(1)  # b 1 n m , True where attended
+            out = nnf.scaled_dot_product_attention(queries.transpose(1, 2), keys.transpose(1, 2),
+                                                   values.transpose(1, 2), attn_mask=attn_mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if mask is not None:
             attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
         attention = attention.softmax(dim=2)
         out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
@@ -159,7 +204,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -262,7 +307,6 @@ class ClipCaptionModel(nn.Module):
 
         #TODO ti attention mask vazw gia to VQA?? pws kataskeazete? se poio apo ta 2 kanei focus?
         out = self.gpt(inputs_embeds=embedding_cat, labels=labels, attention_mask=mask)
-        print()
         return out
 
     def __init__(self, prefix_length: int, clip_length: Optional[int] = None, prefix_size: int = 512,
@@ -290,6 +334,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , no weight gradients are computed for it in backward
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -330,43 +380,71 @@ def train(dataset: ClipCocoDataset, model: ClipCaptionModel, args,
     epochs = args.epochs
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
+    # tf32 tensor cores for the fp32 matmuls
+    torch.set_float32_matmul_precision('high')
     model = model.to(device)
+    if getattr(args, 'compile', True):
+        # in-place, so the saved state_dict keys stay the same ; every batch is padded to max_seq_len
+        model.compile(mode='reduce-overhead', dynamic=False)
     model.train()
-    optimizer = AdamW(model.parameters(), lr=lr)
-    train_dataloader = DataLoader(dataset, batch_size=1, shuffle=True, drop_last=True)
+    # single fused cuda kernel for the whole update over the trainable (mapping) params only ,
+    # weight_decay=0 as in the transformers AdamW
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, weight_decay=0.0,
+                                  fused=True)
+    # batches are built in worker processes and copied from pinned memory while the gpu is busy
+    num_workers = getattr(args, 'num_workers', os.cpu_count() // 2)
+    train_dataloader = DataLoader(dataset, batch_size=1, shuffle=True, drop_last=True, num_workers=num_workers,
+                                  pin_memory=True, persistent_workers=num_workers > 0,
+                                  prefetch_factor=2 if num_workers > 0 else None)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
     )
+    # bf16 needs no loss scaling , the scaler only kicks in on fp16-only gpus
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    # checkpoints are serialized and written by a background thread , the loop only waits for the cpu snapshot
+    saver = ThreadPoolExecutor(max_workers=1)
+    # no full gc pauses in the middle of the epoch , collected by hand every 50 steps
+    gc.disable()
+    # the host only syncs every log_every steps for the progress bar
+    log_every = 50
     # save_config(args)
-    for epoch in range(epochs):
-        print(f">>> Training epoch {epoch}")
-        sys.stdout.flush()
-        progress = tqdm(total=len(train_dataloader), desc=output_prefix)
-        for idx, (tokens, mask, prefix) in enumerate(train_dataloader):
-            model.zero_grad()
-            tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
-
-            outputs = model(tokens, prefix, mask)
-            logits = outputs.logits[:, dataset.prefix_length - 1: -1]
-
-            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
-            progress.set_postfix({"loss": loss.item()})
-            progress.update()
-            if (idx + 1) % 10000 == 0:
-                torch.save(
-                    model.state_dict(),
-                    os.path.join(output_dir, f"{output_prefix}_latest.pt"),
-                )
-        progress.close()
-        if epoch % args.save_every == 0 or epoch == epochs - 1:
-            torch.save(
-                model.state_dict(),
-                os.path.join(output_dir, f"{output_prefix}-{epoch:03d}.pt"),
-            )
+    try:
+        for epoch in range(epochs):
+            print(f">>> Training epoch {epoch}")
+            sys.stdout.flush()
+            progress = tqdm(total=len(train_dataloader), desc=output_prefix)
+            for idx, (tokens, mask, prefix) in enumerate(train_dataloader):
+                tokens, mask = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+                prefix = prefix.to(device, dtype=torch.float32, non_blocking=True)
+
+                with torch.autocast('cuda', dtype=amp_dtype):
+                    outputs = model(tokens, prefix, mask)
+                    logits = outputs.logits[:, dataset.prefix_length - 1: -1]
+
+                    loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+                optimizer.zero_grad(set_to_none=True)
+                if idx % 50 == 0:
+                    # young generation only , the automatic collector is off during training
+                    gc.collect(1)
+                if idx % log_every == 0:
+                    progress.set_postfix({"loss": loss.item()})
+                progress.update()
+                if (idx + 1) % 10000 == 0:
+                    state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+                    saver.submit(torch.save, state, os.path.join(output_dir, f"{output_prefix}_latest.pt"))
+            progress.close()
+            if epoch % args.save_every == 0 or epoch == epochs - 1:
+                state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+                saver.submit(torch.save, state, os.path.join(output_dir, f"{output_prefix}-{epoch:03d}.pt"))
+    finally:
+        # also on an exception (or ctrl-c) , the collector must not stay disabled
+        saver.shutdown(wait=True)
+        gc.enable()
     return model
 
 
@@ -32,11 +32,10 @@ class ClipCocoDataset(Dataset):
 
     def pad_tokens(self, item: int):
         tokens = self.captions_tokens[item]
-        temp_ans = 0
         temp_q = self.questions[item]
-        tokenized_answer = torch.tensor(self.tokenizer.encode(temp_ans), dtype=torch.int64)
         q_range = len(self.tokenizer.encode(temp_q))
-        a_range = len(self.tokenizer.encode(temp_ans)) + 1
+        # the test split has no answers , only the eos position is predicted
+        a_range = 1
         rest_range = self.max_seq_len - q_range - a_range
         if rest_range >= 0:
             need_pred = q_range * [0] + a_range * [1] + rest_range * [0]
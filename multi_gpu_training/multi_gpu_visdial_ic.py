@@ -3,7 +3,7 @@ import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2Tokenizer, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
@@ -12,8 +12,10 @@ import argparse
 import json
 import numpy as np
 from typing import Tuple, Optional, Union
-import copy
+import math
 import time
+from collections import defaultdict
+from contextlib import nullcontext
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from torch.nn.parallel import DistributedDataParallel as DDP
 
@@ -30,76 +32,100 @@ class MappingType(Enum):
     Transformer = 'transformer'
 
 
+def token_cache_path(data_path: str) -> str:
+    return os.path.splitext(data_path)[0] + '_tokens.npz'
+
+
+def token_array_path(data_path: str) -> str:
+    return os.path.splitext(data_path)[0] + '_tokens.npy'
+
+
+def load_token_cache(data_path: str, gpt2_type: str) -> Optional[dict]:
+    # the cache is only valid for the same .pkl (by mtime) and the same tokenizer
+    cache_path, tokens_path = token_cache_path(data_path), token_array_path(data_path)
+    if not os.path.isfile(cache_path) or not os.path.isfile(tokens_path):
+        return None
+    with np.load(cache_path) as cache:
+        if float(cache['mtime']) != os.path.getmtime(data_path) or str(cache['gpt2_type']) != gpt2_type:
+            return None
+        print('loading tokens from ' + tokens_path)
+        arrays = {key: cache[key] for key in cache.files}
+    # .npz members can not be memory mapped , the dense tokens live in their own .npy whose pages are read on
+    # demand and shared between the loader workers
+    arrays['tokens'] = np.load(tokens_path, mmap_mode='r')
+    return arrays
+
+
+def save_token_cache(data_path: str, gpt2_type: str, tokens: np.ndarray, **arrays):
+    # the tokens first , the small .npz with the validity keys is what marks the cache as complete
+    np.save(token_array_path(data_path), tokens)
+    np.savez(token_cache_path(data_path), mtime=os.path.getmtime(data_path), gpt2_type=gpt2_type, **arrays)
+
+
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
-
-    def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+        return len(self.tokens_tensor)
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
-        tokens, mask = self.pad_tokens(item)
+        tokens, mask = self.tokens_tensor[item], self.mask_tensor[item]
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
-
         # tokenized caption, mask attention , (prefix --> actual image)
         return tokens, mask, prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = AutoTokenizer.from_pretrained("microsoft/DialoGPT-large")
+        self.tokenizer = AutoTokenizer.from_pretrained("microsoft/DialoGPT-large", use_fast=True)
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
             all_data = pickle.load(f)
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
-        self.prefixes = all_data["clip_embedding"]
+        # one contiguous float32 (N, prefix_size) tensor, normalized once here instead of per item
+        self.prefixes = torch.as_tensor(all_data["clip_embedding"], dtype=torch.float32).contiguous()
+        if normalize_prefix:
+            self.prefixes = self.prefixes / self.prefixes.norm(2, -1, keepdim=True)
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.captions = [caption['caption'] for caption in captions_raw]
-        if os.path.isfile(f"{data_path[:-4]}_tokens.pkl"):
-            with open(f"{data_path[:-4]}_tokens.pkl", 'rb') as f:
-                self.captions_tokens, self.caption2embedding, self.max_seq_len = pickle.load(f)
+        tokenizer_type = self.tokenizer.name_or_path
+        cache = load_token_cache(data_path, tokenizer_type)
+        if cache is not None:
+            self.tokens_tensor, lengths = torch.from_numpy(cache['tokens']), cache['captions_len']
+            self.max_seq_len, self.caption2embedding = int(cache['max_seq_len']), cache['caption2embedding']
         else:
-            self.captions_tokens = []
-            self.caption2embedding = []
-            max_seq_len = 0
-            for caption in captions_raw:
-                # tokenize to caption
-                self.captions_tokens.append(torch.tensor(self.tokenizer.encode(caption['caption']), dtype=torch.int64))
-                # clip_embedding einai to sequential ID !!
-                self.caption2embedding.append(caption["clip_embedding"])
-                max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-            # self.max_seq_len = max_seq_len
-            with open(f"{data_path[:-4]}_tokens.pkl", 'wb') as f:
-                pickle.dump([self.captions_tokens, self.caption2embedding, max_seq_len], f)
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+            # tokenize all captions in a single batched call of the fast (rust) tokenizer
+            encoded = self.tokenizer(self.captions, add_special_tokens=False)['input_ids']
+            # clip_embedding einai to sequential ID !!
+            self.caption2embedding = [caption["clip_embedding"] for caption in captions_raw]
+            lengths = [len(ids) for ids in encoded]
+            # pad up to the 99th percentile , the few longer captions get truncated
+            self.max_seq_len = int(np.ceil(np.percentile(np.asarray(lengths, dtype=np.int64), 99)))
+            # pad once : tokens (N, max_seq_len) zero padded
+            self.tokens_tensor = torch.zeros(len(encoded), self.max_seq_len, dtype=torch.int64)
+            for i, ids in enumerate(encoded):
+                ids = ids[:self.max_seq_len]
+                self.tokens_tensor[i, :len(ids)] = torch.tensor(ids, dtype=torch.int64)
+            # same validity keys as the train_MTL_IC_VQA cache (.pkl mtime and tokenizer)
+            save_token_cache(data_path, tokenizer_type, tokens=self.tokens_tensor.numpy(),
+                             captions_len=np.minimum(np.asarray(lengths, dtype=np.int64), self.max_seq_len),
+                             max_seq_len=self.max_seq_len,
+                             caption2embedding=np.asarray(self.caption2embedding, dtype=np.int64))
         print('max_seq_len of tokens :  ' + str(self.max_seq_len))
+        self.caption2embedding = torch.as_tensor(self.caption2embedding, dtype=torch.int64)
+        # mask (N, prefix_length + max_seq_len) , ones over the prefix and the real tokens
+        lengths = torch.as_tensor(lengths).clamp(max=self.max_seq_len) + self.prefix_length
+        self.mask_tensor = (torch.arange(self.prefix_length + self.max_seq_len) < lengths.unsqueeze(1)).float()
 
 
 class MLP(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return self.model(x)
+        for layer in self.model:
+            x = layer(x)
+        return x
 
     def __init__(self, sizes: Tuple[int, ...], bias=True, act=nn.Tanh):
         super(MLP, self).__init__()
@@ -108,7 +134,8 @@ class MLP(nn.Module):
             layers.append(nn.Linear(sizes[i], sizes[i + 1], bias=bias))
             if i < len(sizes) - 2:
                 layers.append(act())
-        self.model = nn.Sequential(*layers)
+        # ModuleList keeps the model.{i} state_dict keys of the old nn.Sequential
+        self.model = nn.ModuleList(layers)
 
 
 class MlpTransformer(nn.Module):
@@ -141,22 +168,34 @@ class MultiHeadAttention(nn.Module):
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
+    def forward(self, x, y=None, mask=None, need_weights=False):
         y = y if y is not None else x
         b, n, c = x.shape
         _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
+        # b h n dh
+        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads).transpose(1, 2)
         # b m 2 h dh
         keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        # b h m dh
+        keys, values = keys_values[:, :, 0].transpose(1, 2), keys_values[:, :, 1].transpose(1, 2)
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
-            attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
-        attention = attention.softmax(dim=2)
-        out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
+            # b 1 n m , True where masked out
+            mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient), the attention matrix is never materialized
+            out = nnf.scaled_dot_product_attention(queries, keys, values,
+                                                   attn_mask=None if mask is None else ~mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        # b h n m
+        attention = (queries @ keys.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            attention = attention.masked_fill(mask, float("-inf"))
+        attention = attention.softmax(dim=-1)
+        out = (attention @ values).transpose(1, 2).reshape(b, n, c)
         out = self.project(out)
         return out, attention
 
@@ -164,7 +203,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -280,13 +319,19 @@ class ClipCaptionModel(nn.Module):
 class ClipCaptionPrefix(ClipCaptionModel):
 
     def parameters(self, recurse: bool = True):
-        return self.clip_project.parameters()
+        return (p for p in super(ClipCaptionPrefix, self).parameters(recurse) if p.requires_grad)
 
     def train(self, mode: bool = True):
         super(ClipCaptionPrefix, self).train(mode)
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , DDP registers no hooks / buckets for its weights
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -336,7 +381,7 @@ def generate_topk(
     eos_token_index = tokenizer.eos_token_id
     seq_lengths = torch.ones(batch_size, device=device)
     is_stopped = torch.zeros(batch_size, device=device, dtype=torch.bool)
-    with torch.no_grad():
+    with torch.inference_mode():
         for entry_idx in range(entry_count):
             if embed is not None:
                 generated = embed
@@ -346,18 +391,18 @@ def generate_topk(
                     tokens = tokens.unsqueeze(0).to(device)
 
                 generated = model.gpt.transformer.wte(tokens)
+            past = None
             for i in range(entry_length):
-                outputs = model.gpt(inputs_embeds=generated)
-                logits = outputs.logits
-                logits = logits[:, -1, :] / (temperature if temperature > 0 else 1.0)
-                logits = logits.softmax(-1).log()
-                scores, next_tokens = logits.topk(1, -1)
+                # after the first step only the newest token is fed , keys/values come from the cache
+                outputs = model.gpt(inputs_embeds=generated, past_key_values=past, use_cache=True)
+                past = outputs.past_key_values
+                # greedy , softmax/log/temperature are monotone so the argmax of the raw logits is enough
+                next_tokens = outputs.logits[:, -1, :].argmax(-1, keepdim=True)
                 if tokens is None:
                     tokens = next_tokens
                 else:
                     tokens = torch.cat((tokens, next_tokens), dim=1)
-                next_token_embed = model.gpt.transformer.wte(next_tokens)
-                generated = torch.cat((generated, next_token_embed), dim=1)
+                generated = model.gpt.transformer.wte(next_tokens)
 
                 seq_lengths[~is_stopped] += 1
                 is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze() + \
@@ -373,36 +418,32 @@ def generate_topk(
     return output_texts
 
 
-def merge(list1, list2):
-    assert len(list1) == len(list2)
-    merged_list = [(list1[i], list2[i]) for i in range(0, len(list1))]
-    return merged_list
-
-
 def group_reference_captions(gt_image_ids, gt_captions):
-    mrg = merge(gt_image_ids, gt_captions)
-    temp_dict = {}
-    for key, value in mrg:
-        if key in temp_dict:
-            temp_dict[key].append(value)
-        else:
-            temp_dict[key] = [value]
-    return temp_dict
+    assert len(gt_image_ids) == len(gt_captions)
+    temp_dict = defaultdict(list)
+    for key, value in zip(gt_image_ids, gt_captions):
+        temp_dict[key].append(value)
+    return dict(temp_dict)
 
 
 def apply_validation(model, val_dataloader, epoch, rank, prefix_length):
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    val_loss = 0
+    val_loss = torch.zeros((), device=rank)
     model.eval()
     for idx, (tokens, mask, prefix) in enumerate(val_dataloader):
-        tokens, mask, prefix = tokens.to(rank), mask.to(rank), prefix.to(rank, dtype=torch.float32)
-        with torch.no_grad():
+        # prefixes are already float32 in the dataset , pinned batches are copied asynchronously
+        tokens = tokens.to(rank, non_blocking=True)
+        mask = mask.to(rank, non_blocking=True)
+        prefix = prefix.to(rank, non_blocking=True)
+        with torch.inference_mode():
             outputs = model(tokens, prefix, mask)
             logits = outputs.logits[:, prefix_length - 1: -1]
-            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
-            val_loss = val_loss + loss.item()
+            # padding is ignored through the mask , token 0 ('!') is a real gpt token
+            labels = tokens.masked_fill(mask[:, prefix_length:] == 0, -100)
+            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.flatten(), ignore_index=-100)
+            val_loss += loss
 
-    avg_val_loss = val_loss / len(val_dataloader)
+    avg_val_loss = reduce_mean(val_loss, len(val_dataloader), rank)
     print('*** In Epoch {} the average validation loss : {} ***'.format(epoch, avg_val_loss))
     return avg_val_loss
 
@@ -431,25 +472,37 @@ def train(rank: int, model: ClipCaptionModel, train_dataset: ClipCocoDataset,
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     # ddp_setup(rank, world_size)
     model = model.cuda()
-    model = DDP(model, device_ids=[rank])
+    if myconfig.get('compile'):
+        # in-place compile (inductor fusion + cuda graphs) keeps the state_dict keys unchanged ,
+        # token / mask shapes are fixed by the padded dataset so static shapes are enough
+        model.compile(mode='max-autotune', dynamic=False)
+    # bucketed all-reduce overlaps with backward , grads are views into the buckets (no extra copy)
+    model = DDP(model, device_ids=[rank], bucket_cap_mb=50, gradient_as_bucket_view=True, static_graph=True,
+                find_unused_parameters=False)
 
     # model = nn.Module(model)
     # model = nn.DataParallel(model.to(device))
-    optimizer = AdamW(model.module.parameters(), lr=lr)
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.module.parameters()), lr=lr, weight_decay=0.0,
+                                  fused=True)
     batch_size = myconfig.get('batch_size')
     epochs = myconfig.get('epochs')
+    accum_steps = myconfig.get('accum_steps', 1)
+    num_workers = myconfig.get('num_workers', 0)
 
     train_sampler = sampler = DistributedSampler(train_dataset, shuffle=True)
     train_dataloader = DataLoader(train_dataset, batch_size=batch_size, drop_last=False, sampler=train_sampler,
-                                  pin_memory=True)
+                                  pin_memory=True, num_workers=num_workers, persistent_workers=num_workers > 0,
+                                  prefetch_factor=4 if num_workers > 0 else None)
 
     val_sampler = sampler = DistributedSampler(val_dataset, shuffle=False)
     val_dataloader = DataLoader(val_dataset, batch_size=batch_size, drop_last=False, sampler=val_sampler,
-                                pin_memory=True)
+                                pin_memory=True, num_workers=num_workers, persistent_workers=num_workers > 0,
+                                prefetch_factor=4 if num_workers > 0 else None)
 
     # earlystop = EarlyStopping(tolerance=5,delta=0.5)
     scheduler = get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
+        optimizer, num_warmup_steps=warmup_steps,
+        num_training_steps=epochs * math.ceil(len(train_dataloader) / accum_steps)
     )
     avg_train_loss = []
     avg_val_loss = []
@@ -458,27 +511,37 @@ def train(rank: int, model: ClipCaptionModel, train_dataset: ClipCocoDataset,
     print('*** Initiate Training Phase *** ')
     print()
     for epoch in range(epochs):
-        progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
+        progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1),
+                        disable=not is_main_process())
         train_loss = 0
         for idx, (tokens, mask, prefix) in enumerate(train_dataloader):
             model.train()
-            model.zero_grad()
-            tokens, mask, prefix = tokens.to(rank), mask.to(rank), prefix.to(rank, dtype=torch.float32)
-
-            outputs = model(tokens, prefix, mask)
-            logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
-            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
-            train_loss = train_loss + loss.item()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
+            # prefixes are already float32 in the dataset , pinned batches are copied asynchronously
+            tokens = tokens.to(rank, non_blocking=True)
+            mask = mask.to(rank, non_blocking=True)
+            prefix = prefix.to(rank, non_blocking=True)
+
+            do_step = (idx + 1) % accum_steps == 0 or idx + 1 == len(train_dataloader)
+            # no all-reduce on accumulation steps , no_sync has to enclose both forward and backward
+            with nullcontext() if do_step else model.no_sync():
+                with torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+                    outputs = model(tokens, prefix, mask)
+                    logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
+                    labels = tokens.masked_fill(mask[:, train_dataset.prefix_length:] == 0, -100)
+                    loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.flatten(),
+                                             ignore_index=-100)
+                train_loss = train_loss + loss.item()
+                (loss / accum_steps).backward()
+            if do_step:
+                optimizer.step()
+                scheduler.step()
+                optimizer.zero_grad(set_to_none=True)
             progress.set_postfix({"Batch Train Loss": loss.item()})
             progress.update()
 
         progress.close()
 
-        epoch_avg_train_loss = train_loss / len(train_dataloader)
+        epoch_avg_train_loss = reduce_mean(train_loss, len(train_dataloader), rank)
         avg_train_loss.append(epoch_avg_train_loss)
         print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
 
@@ -492,17 +555,20 @@ def train(rank: int, model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         #     break
 
         if epoch_avg_val_loss < max_val_loss:
-            best_model = copy.deepcopy(model)
             max_val_loss = epoch_avg_val_loss
 
-            torch.save(best_model.module.state_dict(), os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
+            if is_main_process():
+                best_state = {k: v.detach().cpu() for k, v in model.module.state_dict().items()}
+                torch.save(best_state, os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
             print(f'Best Validation loss  : {epoch_avg_val_loss}')
 
         if epoch % myconfig.get('save_every') == 0 or epoch == epochs - 1:
-            torch.save(
+            save_on_master(
                 model.module.state_dict(),
                 os.path.join(output_dir, f"{model_name}-{epoch:03d}.pt"),
             )
+        # the other ranks wait until the checkpoints of this epoch are written
+        dist.barrier()
 
     print('####')
     print(avg_train_loss)
@@ -539,6 +605,15 @@ def is_main_process():
     return get_rank() == 0
 
 
+def reduce_mean(total, count, device):
+    # mean over the batches of all ranks , not only over the local shard
+    stats = torch.stack([torch.as_tensor(total, dtype=torch.float64, device=device),
+                         torch.as_tensor(count, dtype=torch.float64, device=device)])
+    if is_dist_avail_and_initialized():
+        dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+    return (stats[0] / stats[1]).item()
+
+
 def save_on_master(*args, **kwargs):
     if is_main_process():
         torch.save(*args, **kwargs)
@@ -601,6 +676,9 @@ def main():
     myconfig = {
         'epochs': 6,
         'batch_size': 32,
+        'accum_steps': 1,
+        'compile': True,
+        'num_workers': 4,
         'train_data': './data/visdial/clip_feat_ViT-B_32_train_ic.pkl',
         'val_data': './data/visdial/clip_feat_ViT-B_32_val_ic.pkl',
         'out_dir': './visdial_ic',
@@ -3,7 +3,7 @@ import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2TokenizerFast, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
@@ -12,7 +12,8 @@ import argparse
 import json
 import numpy as np
 from typing import Tuple, Optional, Union
-import copy
+import math
+from contextlib import nullcontext
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 import torch.distributed as dist
@@ -30,59 +31,38 @@ class MappingType(Enum):
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
-
-    def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        temp_ans = self.answers[item]
-        temp_q = self.questions[item]
-        tokenized_answer = torch.tensor(self.tokenizer.encode(temp_ans), dtype=torch.int64)
-        q_range = len(self.tokenizer.encode(temp_q))
-        a_range = len(self.tokenizer.encode(temp_ans)) + 1
-        rest_range = self.max_seq_len - q_range - a_range
-        if rest_range >= 0:
-            need_pred = q_range * [0] + a_range * [1] + rest_range * [0]
-            need_pred_4gpt = q_range * [1] + a_range * [1] + rest_range * [0]
-        elif rest_range < 0:
+        return len(self.tokens_all)
+
+    def pad_tokens(self, tokens: torch.Tensor, q_range: int, a_range: int):
+        idx = self.idx_range
+        mask = ((idx >= q_range) & (idx < q_range + a_range)).float()
+        mask4gpt = (idx < q_range + a_range).float()
+        if q_range + a_range > self.max_seq_len:
             # TODO
             # print('SOOS')
-            need_pred = self.max_seq_len * [0]
-            need_pred_4gpt = self.max_seq_len * [0]
+            mask.zero_()
+            mask4gpt.zero_()
 
         padding = self.max_seq_len - tokens.shape[0]
         if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
+            tokens = torch.cat((tokens, self.pad_vec[:padding]))
         elif padding < 0:
             tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
         # A boolean tensor that is True where input is greater than or equal to other and False elsewhere
         # mask = tokens.ge(0)  # mask is zero where we out of sequence
         # tokens[~mask] = 0
-        mask = torch.FloatTensor(need_pred)
-        mask4gpt = torch.FloatTensor(need_pred_4gpt)
-
         omask = tokens.ge(0)  # mask is zero where we out of sequence
         tokens[~omask] = 0
-
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        mask4gpt = torch.cat((torch.ones(self.prefix_length), mask4gpt), dim=0)  # adding prefix mask
         return tokens, mask, mask4gpt
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
-        tokens, mask, mask4gpt = self.pad_tokens(item)
-        prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
-
         # tokenized caption, mask attention , (prefix --> actual image)
-        return tokens, mask, mask4gpt, prefix
+        return self.tokens_all[item], self.mask_all[item], self.mask4gpt_all[item], \
+               self.prefixes[self.caption2embedding[item]]
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained(gpt2_type)
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(gpt2_type)
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
@@ -90,36 +70,47 @@ class ClipCocoDataset(Dataset):
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
         self.prefixes = all_data["clip_embedding"]
+        if self.normalize_prefix:
+            self.prefixes = nnf.normalize(self.prefixes.float(), dim=-1)
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.answers = [caption['answer'] for caption in captions_raw]
         self.questions = [caption['question'] for caption in captions_raw]
         ##
-        self.captions_tokens = []
-        self.caption2embedding = []
-        # self.temp_answers_tens = []
+        self.caption2embedding = [caption["clip_embedding"] for caption in captions_raw]
         eos = self.tokenizer.eos_token_id
-        max_seq_len = 0
-        max_ans_len = 0
-        for i, caption in enumerate(captions_raw):
-            # tokenize to caption
-            self.captions_tokens.append(
-                torch.tensor(self.tokenizer.encode(caption['question'] + ' ' + caption['answer']) + [eos],
-                             dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-
-            temp = torch.tensor(self.tokenizer.encode(caption['answer']), dtype=torch.int64)
-            max_ans_len = max(max_ans_len, temp.shape[0])
-
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+        # one batched call per field instead of three encode() calls per sample
+        encode_kwargs = dict(add_special_tokens=False, return_attention_mask=False)
+        qa_ids = self.tokenizer([q + ' ' + a for q, a in zip(self.questions, self.answers)],
+                                **encode_kwargs)['input_ids']
+        q_ranges = [len(ids) for ids in self.tokenizer(self.questions, **encode_kwargs)['input_ids']]
+        ans_lens = [len(ids) for ids in self.tokenizer(self.answers, **encode_kwargs)['input_ids']]
+        a_ranges = [ans_len + 1 for ans_len in ans_lens]
+        captions_tokens = [torch.as_tensor(ids + [eos], dtype=torch.int64) for ids in qa_ids]
+        max_ans_len = max(ans_lens)
+
+        # + 1 for the eos appended to every caption , ddof=1 matches the torch std used before
+        all_len = np.fromiter((len(ids) + 1 for ids in qa_ids), dtype=np.float32, count=len(qa_ids))
+        self.max_seq_len = min(int(all_len.mean() + all_len.std(ddof=1) * 10), int(all_len.max()))
         self.max_ans_len = max_ans_len
         print('max_seq_len of whole tokens :  ' + str(self.max_seq_len))
         print('max_ans_len of answers :  ' + str(self.max_ans_len))
 
+        # pad every sample once, __getitem__ only indexes into these
+        n = len(captions_tokens)
+        # constants shared by every pad_tokens call , the prefix ones come from the ones init below
+        self.idx_range = torch.arange(self.max_seq_len)
+        self.pad_vec = torch.full((self.max_seq_len,), -1, dtype=torch.int64)
+        self.tokens_all = torch.zeros(n, self.max_seq_len, dtype=torch.int64)
+        self.mask_all = torch.ones(n, self.prefix_length + self.max_seq_len, dtype=torch.float32)
+        self.mask4gpt_all = torch.ones(n, self.prefix_length + self.max_seq_len, dtype=torch.float32)
+        for i, (tokens, q_range, a_range) in enumerate(zip(captions_tokens, q_ranges, a_ranges)):
+            tokens, mask, mask4gpt = self.pad_tokens(tokens, q_range, a_range)
+            self.tokens_all[i] = tokens
+            self.mask_all[i, self.prefix_length:] = mask
+            self.mask4gpt_all[i, self.prefix_length:] = mask4gpt
+
 
 class MLP(nn.Module):
 
@@ -166,22 +157,34 @@ class MultiHeadAttention(nn.Module):
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
+    def forward(self, x, y=None, mask=None, need_weights=False):
         y = y if y is not None else x
         b, n, c = x.shape
         _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
+        # b h n dh
+        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads).transpose(1, 2)
         # b m 2 h dh
         keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        # b h m dh
+        keys, values = keys_values[:, :, 0].transpose(1, 2), keys_values[:, :, 1].transpose(1, 2)
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
-            attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
-        attention = attention.softmax(dim=2)
-        out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
+            # b 1 n m , True where masked out
+            mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient), the attention matrix is never materialized
+            out = nnf.scaled_dot_product_attention(queries, keys, values,
+                                                   attn_mask=None if mask is None else ~mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        # b h n m
+        attention = (queries @ keys.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            attention = attention.masked_fill(mask, float("-inf"))
+        attention = attention.softmax(dim=-1)
+        out = (attention @ values).transpose(1, 2).reshape(b, n, c)
         out = self.project(out)
         return out, attention
 
@@ -189,7 +192,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -235,16 +238,10 @@ class Transformer(nn.Module):
         self.enc_dec = enc_dec
         if enc_dec:
             num_layers = num_layers * 2
-        layers = []
-        for i in range(num_layers):
-            if i % 2 == 0 and enc_dec:  # cross
-                layers.append(TransformerLayer(dim_self, dim_ref, num_heads, mlp_ratio, act=act, norm_layer=norm_layer))
-            elif enc_dec:  # self
-                layers.append(
-                    TransformerLayer(dim_self, dim_self, num_heads, mlp_ratio, act=act, norm_layer=norm_layer))
-            else:  # self or cross
-                # dim self 768
-                layers.append(TransformerLayer(dim_self, dim_ref, num_heads, mlp_ratio, act=act, norm_layer=norm_layer))
+        # only enc_dec alternates cross (dim_ref) and self (dim_self) layers
+        refs = [dim_ref if i % 2 == 0 or not enc_dec else dim_self for i in range(num_layers)]
+        # bias=False (TransformerLayer default) reaches the q/kv projections of every layer
+        layers = [TransformerLayer(dim_self, ref, num_heads, mlp_ratio, act=act, norm_layer=norm_layer) for ref in refs]
         self.layers = nn.ModuleList(layers)
 
 
@@ -323,6 +320,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , autograd only keeps the graph that the projected prefix flows through
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -354,23 +357,22 @@ def load_model(config_path: str, epoch_or_latest: Union[str, int] = '_latest'):
     return model, parser
 
 
-def apply_validation(model, val_dataloader, epoch,rank, prefix_length):
+def apply_validation(model, val_dataloader, epoch,rank, prefix_length, amp_dtype=torch.bfloat16):
     # device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    val_loss = 0
+    val_loss = torch.zeros((), device=rank)
     model.eval()
     for idx, (tokens, mask, mask4gpt, prefix) in enumerate(val_dataloader):
-        tokens, mask, mask4gpt, prefix = tokens.to(rank), mask.to(rank), mask4gpt.to(rank), prefix.to(rank,dtype=torch.float32)
-        with torch.no_grad():
+        tokens, mask, mask4gpt, prefix = tokens.to(rank, non_blocking=True), mask.to(rank, non_blocking=True), \
+            mask4gpt.to(rank, non_blocking=True), prefix.to(rank, non_blocking=True)
+        with torch.no_grad(), torch.autocast('cuda', dtype=amp_dtype):
             outputs = model(tokens, prefix, mask4gpt)
             logits = outputs.logits[:, prefix_length - 1: -1]
-            new_mask = mask[:, 10:]
-            bool_mask = new_mask.ge(1).view(-1)
-            final_logits = logits.reshape(-1, logits.shape[-1])
-            finally_tok = tokens.view(-1)
-            loss = nnf.cross_entropy(final_logits[bool_mask], finally_tok[bool_mask], ignore_index=0)
-            val_loss = val_loss + loss.item()
-
-    avg_val_loss = val_loss / len(val_dataloader)
+            # answer positions only (token 0 stays ignored as before) , no gather of the logits
+            labels = tokens.masked_fill(mask[:, 10:].lt(1) | tokens.eq(0), -100)
+            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.view(-1), ignore_index=-100)
+            val_loss += loss.float()
+
+    avg_val_loss = val_loss.item() / len(val_dataloader)
     print('*** In Epoch {} the average validation loss : {} ***'.format(epoch, avg_val_loss))
     return avg_val_loss
 
@@ -390,22 +392,28 @@ class EarlyStopping:
                 self.early_stop = True
 
 
-def generate_per_batch(model, prefix, question, batch_size,masky):
+def generate_per_batch(model, tokenizer, prefix, question, batch_size, masky, stop_token_index, eos_token_index,
+                       amp_dtype=torch.bfloat16):
     tokens = None
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-    stop_token_index = tokenizer.encode('.')[0]
-    eos_token_index = tokenizer.eos_token_id
     max_length = 67
     temperature = 1.0
     seq_lengths = torch.ones(batch_size, device=device)
     is_stopped = torch.zeros(batch_size, device=device, dtype=torch.bool)
-    with torch.no_grad():
+    with torch.no_grad(), torch.autocast(device.type, dtype=amp_dtype):
         embed = model.clip_project(prefix)
         embedding_text = model.gpt.transformer.wte(question)
         generated = torch.cat((embed, embedding_text), dim=1)
+        # attention mask for every position we may generate , grown by moving cur_len only
+        cur_len = masky.shape[1]
+        masky_full = torch.ones(batch_size, cur_len + max_length, device=device)
+        masky_full[:, :cur_len] = masky
+        past = None
         for i in range(max_length):
-            outputs = model.gpt(inputs_embeds=generated,attention_mask=masky)
+            # after the first step only the newest token is fed , the rest comes from the kv cache
+            outputs = model.gpt(inputs_embeds=generated, attention_mask=masky_full[:, :cur_len],
+                                past_key_values=past, use_cache=True)
+            past = outputs.past_key_values
 
             logits = outputs.logits
             logits = logits[:, -1, :] / (temperature if temperature > 0 else 1.0)
@@ -415,14 +423,15 @@ def generate_per_batch(model, prefix, question, batch_size,masky):
                 tokens = next_tokens
             else:
                 tokens = torch.cat((tokens, next_tokens), dim=1)
-            next_token_embed = model.gpt.transformer.wte(next_tokens)
-            generated = torch.cat((generated, next_token_embed), dim=1)
-            masky = torch.cat((masky, torch.ones((batch_size, 1), dtype=torch.float)), dim=1)
+            generated = model.gpt.transformer.wte(next_tokens)
+            cur_len += 1
 
-            seq_lengths[~is_stopped] += 1
+            # arithmetic instead of a boolean index , which would run nonzero and sync every step
+            seq_lengths += (~is_stopped).to(seq_lengths.dtype)
             is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze() + \
                          next_tokens.eq(eos_token_index).squeeze()
-            if is_stopped.all():
+            # .all() syncs with the host , only check every 8 steps
+            if (i & 7) == 0 and is_stopped.all():
                 break
 
         output_list = tokens.cpu().numpy()
@@ -446,13 +455,15 @@ def validation_generation(model, val_dataset, weights_path=None):
     model = model.to(device)
     model.eval()
     predicted_answers = []
+    tokenizer = val_dataset.tokenizer
+    stop_token_index = tokenizer.encode('.')[0]
+    eos_token_index = tokenizer.eos_token_id
 
     for (captions, mask, mask4gpt, prefix) in tqdm(val_dataloader, total=len(val_dataloader),
                                                    desc='Generate Captions/Answers'):
-        captions, mask, mask4gpt, prefix = captions.to(device), mask.to(device), mask4gpt.to(device), prefix.to(device,
-                                                                                                                dtype=torch.float32)
+        captions, mask, mask4gpt, prefix = captions.to(device), mask.to(device), mask4gpt.to(device), prefix.to(device)
         temp_question_mask = torch.logical_xor(mask[:, 10:], mask4gpt[:, 10:]).float()
-        masky = torch.cat((torch.ones((batch_size, 10),dtype=torch.float),temp_question_mask), dim=1)
+        masky = torch.cat((torch.ones((batch_size, 10), device=device), temp_question_mask), dim=1)
 
         new_mask = mask[:, 10:].ge(1)
         new_mask4gpt = mask4gpt[:, 10:].ge(1)
@@ -467,7 +478,8 @@ def validation_generation(model, val_dataset, weights_path=None):
         # question = questions.squeeze()
         # question = question[question.nonzero()].squeeze()
 
-        output_texts = generate_per_batch(model, prefix, questions, batch_size, masky)
+        output_texts = generate_per_batch(model, tokenizer, prefix, questions, batch_size, masky,
+                                          stop_token_index, eos_token_index)
         predicted_answers.extend(output_texts)
 
     assert len(predicted_answers) == len(gt_answers)
@@ -498,23 +510,38 @@ def train(rank: int , model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         os.makedirs(output_dir)
 
     model = model.cuda()
-    model = DDP(model, device_ids=[rank])
-
-    optimizer = AdamW(model.module.parameters(), lr=lr)
+    model = DDP(model, device_ids=[rank], bucket_cap_mb=50, gradient_as_bucket_view=True, static_graph=True,
+                find_unused_parameters=False)
+    if myconfig.get('compile'):
+        # in-place, so model.module and the state_dict keys stay as they were
+        model.compile(mode='reduce-overhead', dynamic=False)
+
+    # single fused cuda kernel for the whole update
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.module.parameters()), lr=lr, weight_decay=0.0,
+                                  fused=True)
+    # bf16 keeps the fp32 exponent range, only fp16 needs loss scaling
+    amp_dtype = {'bfloat16': torch.bfloat16, 'float16': torch.float16}[myconfig.get('amp_dtype')]
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
     batch_size = myconfig.get('batch_size')
     epochs = myconfig.get('epochs')
+    accum_steps = myconfig.get('accum_steps', 1)
+    log_every = 50
+    num_workers = myconfig.get('num_workers', 0)
 
     train_sampler = sampler = DistributedSampler(train_dataset, shuffle=True)
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, drop_last=False, sampler=train_sampler,
-                                  pin_memory=True)
+    # drop_last keeps every train batch the same shape for the compiled graph
+    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, drop_last=True, sampler=train_sampler,
+                                  pin_memory=True, num_workers=num_workers, persistent_workers=num_workers > 0,
+                                  prefetch_factor=4 if num_workers > 0 else None)
 
     val_sampler = sampler = DistributedSampler(val_dataset, shuffle=False)
     val_dataloader = DataLoader(val_dataset, batch_size=batch_size, drop_last=False, sampler=val_sampler,
-                                pin_memory=True)
+                                pin_memory=True, num_workers=num_workers, persistent_workers=num_workers > 0,
+                                prefetch_factor=4 if num_workers > 0 else None)
 
     # earlystop = EarlyStopping(tolerance=5, delta=0.5)
     scheduler = get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
+        optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * math.ceil(len(train_dataloader) / accum_steps)
     )
     avg_train_loss = []
     avg_val_loss = []
@@ -524,35 +551,45 @@ def train(rank: int , model: ClipCaptionModel, train_dataset: ClipCocoDataset,
     print()
     for epoch in range(epochs):
         progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
-        train_loss = 0
+        # summed on the device , .item() only when the progress bar is refreshed
+        train_loss = torch.zeros((), device=rank)
+        window_loss = torch.zeros((), device=rank)
         for idx, (tokens, mask, mask4gpt, prefix) in enumerate(train_dataloader):
             model.train()
-            model.zero_grad()
-            tokens, mask, mask4gpt, prefix = tokens.to(rank), mask.to(rank), mask4gpt.to(rank), prefix.to(rank,dtype=torch.float32)
-
-            outputs = model(tokens, prefix, mask4gpt)
-            logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
-            new_mask = mask[:, 10:]
-            bool_mask = new_mask.ge(1).view(-1)
-            final_logits = logits.reshape(-1, logits.shape[-1])
-            finally_tok = tokens.view(-1)
-
-            loss = nnf.cross_entropy(final_logits[bool_mask], finally_tok[bool_mask], ignore_index=0)
-            train_loss = train_loss + loss.item()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
-            progress.set_postfix({"Batch Train Loss": loss.item()})
+            tokens, mask, mask4gpt, prefix = tokens.to(rank, non_blocking=True), mask.to(rank, non_blocking=True), \
+                mask4gpt.to(rank, non_blocking=True), prefix.to(rank, non_blocking=True)
+
+            do_step = (idx + 1) % accum_steps == 0 or idx + 1 == len(train_dataloader)
+            # no all-reduce on accumulation steps , no_sync has to enclose both forward and backward
+            with nullcontext() if do_step else model.no_sync():
+                with torch.autocast('cuda', dtype=amp_dtype):
+                    outputs = model(tokens, prefix, mask4gpt)
+                    logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
+                    # answer positions only (token 0 stays ignored as before) , no gather of the logits
+                    labels = tokens.masked_fill(mask[:, 10:].lt(1) | tokens.eq(0), -100)
+                    loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.view(-1),
+                                             ignore_index=-100)
+                train_loss += loss.detach().float()
+                window_loss += loss.detach().float()
+                scaler.scale(loss / accum_steps).backward()
+            if do_step:
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+                optimizer.zero_grad()
+            if (idx + 1) % log_every == 0:
+                progress.set_postfix({"Batch Train Loss": (window_loss / log_every).item()})
+                window_loss.zero_()
             progress.update()
 
         progress.close()
 
-        epoch_avg_train_loss = train_loss / len(train_dataloader)
+        epoch_avg_train_loss = train_loss.item() / len(train_dataloader)
         avg_train_loss.append(epoch_avg_train_loss)
         print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
 
-        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, rank=rank,prefix_length=val_dataset.prefix_length)
+        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, rank=rank,prefix_length=val_dataset.prefix_length,
+                                              amp_dtype=amp_dtype)
         avg_val_loss.append(epoch_avg_val_loss)
 
         # earlystop(epoch_avg_train_loss, epoch_avg_val_loss)
@@ -561,10 +598,11 @@ def train(rank: int , model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         #     break
 
         if epoch_avg_val_loss < max_val_loss:
-            best_model = copy.deepcopy(model)
             max_val_loss = epoch_avg_val_loss
 
-            torch.save(best_model.state_dict(), os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
+            if is_main_process():
+                best_state = {k: v.detach().cpu() for k, v in model.module.state_dict().items()}
+                torch.save(best_state, os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
             print(f'Best Validation loss  : {epoch_avg_val_loss}')
 
         if epoch % myconfig.get('save_every') == 0 or epoch == epochs - 1:
@@ -696,7 +734,8 @@ def main():
 
     myconfig = {
         'epochs': 6,
-        'batch_size': 1,
+        'batch_size': 32,
+        'accum_steps': 1,
         'train_data': './data/visdial/clip_feat_ViT-B_32_train_vqa.pkl',
         'val_data': './data/visdial/clip_feat_ViT-B_32_val_vqa.pkl',
         'out_dir': './visdial_vqa',
@@ -708,6 +747,9 @@ def main():
         'num_layers': 8,
         'is_rn': False,
         'normalize_prefix': False,
+        'amp_dtype': 'bfloat16',
+        'compile': True,
+        'num_workers': 4,
         'model_name': 'visdial_vqa_model',
         'weights_path': ''
 
@@ -7,7 +7,7 @@ import json
 import os
 from tqdm import tqdm
 import argparse
-from diffusers import StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 
 
 
@@ -16,6 +16,9 @@ def main(clip_model_type: str):
     model_id = "CompVis/stable-diffusion-v1-4"
     pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
     pipe = pipe.to("cuda")
+    # multistep dpm-solver matches the default sampler's images in far fewer unet steps
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    pipe.set_progress_bar_config(disable=True)
     pipe.safety_checker = lambda images, clip_input: (images, False)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -34,7 +37,7 @@ def main(clip_model_type: str):
         temp_ann_img_id = ann[i].get('image_id')
         temp_ann_caption = ann[i].get('caption')
 
-        image = pipe(temp_ann_caption).images[0]
+        image = pipe(temp_ann_caption, num_inference_steps=25).images[0]
         image.save('./data/coco/generative_images/{}.jpg'.format(i))
         image = preprocess(image).unsqueeze(0).to(device)
 
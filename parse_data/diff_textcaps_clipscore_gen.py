@@ -7,57 +7,43 @@ import json
 import os
 from tqdm import tqdm
 import argparse
-from diffusers import StableDiffusionPipeline
+from diffusers import StableDiffusionPipeline, DPMSolverMultistepScheduler
 
 
 def decapitalize_first_letter(s, upper_rest=False):
     return ''.join([s[:1].lower(), (s[1:].upper() if upper_rest else s[1:])])
 
 
-def get_clip_score(image, text, clip_model, preprocess):
-    # Load the pre-trained CLIP model and the image
-    # model, preprocess = clip.load('ViT-B/32')
-
-    # Preprocess the image and tokenize the text
-    image_input = preprocess(image).unsqueeze(0)
-    text_input = clip.tokenize([text])
-
-    # Move the inputs to GPU if available
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    image_input = image_input.to(device)
-    text_input = text_input.to(device)
-    # model = model.to(device)
-
-    # Generate embeddings for the image and text
+def find_best_clip_score(gen_images, paraphrased_texts, clip_model, preprocess):
+    # score every generated image in one batched clip forward instead of one call per image ,
+    # the same function is copied in each diff_*_clipscore_gen / diff_textcaps_t5_gen script
+    device = next(clip_model.parameters()).device
+    # channels_last suits the patch-embedding conv
+    image_input = torch.stack([preprocess(image) for image in gen_images])
+    image_input = image_input.to(device, memory_format=torch.channels_last)
+    text_input = clip.tokenize(paraphrased_texts).to(device)
+
+    # Generate embeddings for the images and texts
     with torch.no_grad():
         image_features = clip_model.encode_image(image_input)
         text_features = clip_model.encode_text(text_input)
 
-    # Normalize the features
-    image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-    # Calculate the cosine similarity to get the CLIP score
-    clip_score = torch.matmul(image_features, text_features.T).item()
+    # Calculate the cosine similarity of each image with its text to get the CLIP scores
+    clip_scores = (image_features / image_features.norm(dim=-1, keepdim=True)
+                   * text_features / text_features.norm(dim=-1, keepdim=True)).sum(dim=-1)
+    index_clip_score = clip_scores.argmax().item()
 
-    return clip_score
-
-
-def find_best_clip_score(gen_images, paraphrased_texts, clip_model, preprocess):
-    max_clip_score = -1
-    index_clip_score = None
-    for i, (temp_im, temp_txt) in enumerate(zip(gen_images, paraphrased_texts)):
-        temp = get_clip_score(temp_im, temp_txt, clip_model, preprocess)
-        if max_clip_score < temp:
-            max_clip_score = temp
-            index_clip_score = i
-    return index_clip_score
+    # the raw features of the chosen image are its prefix , no need to encode it again
+    return index_clip_score, image_features[index_clip_score:index_clip_score + 1]
 
 
 def main(clip_model_type: str):
     model_id = "CompVis/stable-diffusion-v1-4"
     pipe = StableDiffusionPipeline.from_pretrained(model_id, torch_dtype=torch.float16)
     pipe = pipe.to("cuda")
+    # multistep dpm-solver matches the default sampler's images in far fewer unet steps
+    pipe.scheduler = DPMSolverMultistepScheduler.from_config(pipe.scheduler.config)
+    pipe.set_progress_bar_config(disable=True)
     pipe.safety_checker = lambda images, clip_input: (images, False)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -80,16 +66,13 @@ def main(clip_model_type: str):
 
         tempy = 'High photo-realistic, ' + decapitalize_first_letter(temp_ann_caption)
         tempy_default_list = [temp_ann_caption] * 5
-        temp_gen_images = pipe([tempy] * 5, num_inference_steps=100, guidance_scale=7.5).images
+        temp_gen_images = pipe([tempy] * 5, num_inference_steps=25, guidance_scale=7.5).images
 
-        res_index = find_best_clip_score(temp_gen_images, tempy_default_list, clip_model, preprocess)
+        res_index, prefix = find_best_clip_score(temp_gen_images, tempy_default_list, clip_model, preprocess)
         image = temp_gen_images[res_index]
 
         image.save('./data/textcaps/generative_images_clipscore/{}.jpg'.format(i))
-        image = preprocess(image).unsqueeze(0).to(device)
-
-        with torch.no_grad():
-            prefix = clip_model.encode_image(image).cpu()
+        prefix = prefix.cpu()
         temp_dict = {
             'caption': temp_ann_caption,
             'clip_embedding': i,
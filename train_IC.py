@@ -1,9 +1,9 @@
 import torch
 import torch.nn as nn
 from torch.nn import functional as nnf
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2TokenizerFast, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
@@ -19,7 +19,9 @@ import copy
 # from evaluation.cider.cider import Cider
 # from evaluation.meteor.meteor import Meteor
 # from evaluation.tokenizer.ptbtokenizer import PTBTokenizer
+import math
 import time
+from collections import defaultdict
 
 class MappingType(Enum):
     MLP = 'mlp'
@@ -29,37 +31,24 @@ class MappingType(Enum):
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
-
-    def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+        return len(self.tokens_padded)
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
-        tokens, mask = self.pad_tokens(item)
-        prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
-
         # tokenized caption, mask attention , (prefix --> actual image)
-        return tokens, mask, prefix
+        return self.tokens_padded[item], self.masks[item], self.prefixes[self.caption2embedding[item]]
+
+    def collate(self, batch):
+        # pads only up to the longest caption of the batch (rounded up to a multiple of 8 , so a compiled model
+        # sees a handful of shapes) instead of the global max_seq_len
+        tokens, mask, prefix = (torch.stack(t) for t in zip(*batch))
+        batch_len = int(mask[:, self.prefix_length:].sum(dim=1).max())
+        batch_len = min(-(-batch_len // 8) * 8, self.max_seq_len)
+        return tokens[:, :batch_len], mask[:, :self.prefix_length + batch_len], prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
-                 normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+                 normalize_prefix=False, half_prefix=False, tokenizer=None):
+        # main() shares one tokenizer between the datasets and the generation
+        self.tokenizer = tokenizer if tokenizer is not None else GPT2TokenizerFast.from_pretrained('gpt2')
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
@@ -67,24 +56,73 @@ class ClipCocoDataset(Dataset):
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
         self.prefixes = all_data["clip_embedding"]
+        if not torch.is_tensor(self.prefixes):
+            # one contiguous (N, prefix_size) tensor , rows are gathered in C
+            self.prefixes = torch.as_tensor(np.stack(self.prefixes), dtype=torch.float32)
+        self.prefixes = self.prefixes.contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            prefixes = self.prefixes.float()
+            self.prefixes = prefixes / prefixes.norm(2, dim=-1, keepdim=True)
+        if half_prefix:
+            # half the host to device bytes , training consumes them under autocast
+            self.prefixes = self.prefixes.half()
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.captions = [caption['caption'] for caption in captions_raw]
-        self.captions_tokens = []
-        self.caption2embedding = []
-        max_seq_len = 0
-        for caption in captions_raw:
-            # tokenize to caption
-            self.captions_tokens.append(torch.tensor(self.tokenizer.encode(caption['caption']), dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+        # tokenize all captions in one batched call of the fast (rust) tokenizer
+        encoded = self.tokenizer(self.captions, add_special_tokens=False)['input_ids']
+        # clip_embedding einai to sequential ID !!
+        self.caption2embedding = torch.as_tensor([caption["clip_embedding"] for caption in captions_raw],
+                                                 dtype=torch.int64)
+
+        # ddof=1 matches the torch std used before
+        all_len = np.fromiter((len(ids) for ids in encoded), dtype=np.int64, count=len(encoded))
+        self.max_seq_len = min(int(all_len.mean() + all_len.std(ddof=1) * 10), int(all_len.max()))
         print('max_seq_len of tokens :  ' + str(self.max_seq_len))
 
+        # pad once into contiguous (N, max_seq_len) tokens and (N, prefix_length + max_seq_len) masks
+        captions_tokens = [torch.as_tensor(ids[:self.max_seq_len], dtype=torch.int64) for ids in encoded]
+        # max_seq_len never exceeds the longest caption , so pad_sequence already pads to it
+        self.tokens_padded = nn.utils.rnn.pad_sequence(captions_tokens, batch_first=True, padding_value=0)
+        lengths = torch.from_numpy(all_len).clamp(max=self.max_seq_len)
+        self.lengths = lengths.numpy()
+        mask_body = (torch.arange(self.max_seq_len) < lengths.unsqueeze(1)).float()
+        self.masks = torch.cat([torch.ones(len(captions_tokens), self.prefix_length), mask_body], dim=1)
+
+
+class LengthBucketSampler(Sampler):
+    # batches of captions with similar length : indices are sorted by length , split into num_buckets buckets
+    # (deciles by default) and batched inside each bucket
+
+    def __init__(self, lengths, batch_size: int, num_buckets: int = 10, shuffle: bool = False, drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_buckets = num_buckets
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        order = np.argsort(self.lengths, kind='stable')
+        batches = []
+        for bucket in np.array_split(order, self.num_buckets):
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if len(batch) == self.batch_size or not self.drop_last:
+                    batches.append(batch.tolist())
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
+
+    def __len__(self):
+        sizes = [len(bucket) for bucket in np.array_split(np.arange(len(self.lengths)), self.num_buckets)]
+        if self.drop_last:
+            return sum(size // self.batch_size for size in sizes)
+        return sum(-(-size // self.batch_size) for size in sizes)
+
 
 class MLP(nn.Module):
 
@@ -131,22 +169,34 @@ class MultiHeadAttention(nn.Module):
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
+    def forward(self, x, y=None, mask=None, need_weights=False):
         y = y if y is not None else x
         b, n, c = x.shape
         _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
+        # b h n dh
+        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads).transpose(1, 2)
         # b m 2 h dh
         keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        # b h m dh
+        keys, values = (t.transpose(1, 2) for t in keys_values.unbind(dim=2))
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
-            attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
-        attention = attention.softmax(dim=2)
-        out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
+            # b 1 n m , True where masked out
+            mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient), the attention matrix is never materialized
+            out = nnf.scaled_dot_product_attention(queries, keys, values,
+                                                   attn_mask=None if mask is None else ~mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        # b h n m
+        attention = (queries @ keys.transpose(-2, -1)) * self.scale
+        if mask is not None:
+            attention = attention.masked_fill(mask, float("-inf"))
+        attention = attention.softmax(dim=-1)
+        out = (attention @ values).transpose(1, 2).reshape(b, n, c)
         out = self.project(out)
         return out, attention
 
@@ -154,7 +204,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -277,6 +327,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , autograd only keeps the graph that the projected prefix flows through
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -310,17 +366,18 @@ def load_model(config_path: str, epoch_or_latest: Union[str, int] = '_latest'):
 
 def apply_validation(model, val_dataloader, epoch, prefix_length):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    val_loss = 0
+    val_loss = torch.zeros((), device=device)
     model.eval()
     for idx, (tokens, mask, prefix) in enumerate(val_dataloader):
-        tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
+        tokens, mask, prefix = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True), \
+            prefix.to(device, non_blocking=True).float()
         with torch.no_grad():
             outputs = model(tokens, prefix, mask)
             logits = outputs.logits[:, prefix_length - 1: -1]
             loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
-            val_loss = val_loss + loss.item()
+            val_loss += loss
 
-    avg_val_loss = val_loss / len(val_dataloader)
+    avg_val_loss = val_loss.item() / len(val_dataloader)
     print('*** In Epoch {} the average validation loss : {} ***'.format(epoch, avg_val_loss))
     return avg_val_loss
 
@@ -340,6 +397,43 @@ class EarlyStopping:
                 self.early_stop = True
 
 
+def capture_train_step(model, tokens, mask, prefix, prefix_length, amp_dtype):
+    # records forward , loss and backward of one step into a cuda graph ; the returned function copies a batch into
+    # the static inputs and replays it. the captured backward rewrites .grad on every replay , so grads must not be
+    # zeroed / set to None afterwards
+    static_tokens, static_mask, static_prefix = tokens.clone(), mask.clone(), prefix.clone()
+
+    def step():
+        with torch.autocast('cuda', dtype=amp_dtype, cache_enabled=False):
+            outputs = model(static_tokens, static_prefix, static_mask)
+        logits = outputs.logits[:, prefix_length - 1: -1].float()
+        loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), static_tokens.flatten(), ignore_index=0)
+        loss.backward()
+        return loss
+
+    # warm up on a side stream (cublas workspaces , lazy init) before capturing
+    side_stream = torch.cuda.Stream()
+    side_stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(side_stream):
+        for _ in range(3):
+            step()
+            model.zero_grad(set_to_none=True)
+    torch.cuda.current_stream().wait_stream(side_stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_loss = step()
+
+    def replay(tokens, mask, prefix):
+        static_tokens.copy_(tokens)
+        static_mask.copy_(mask)
+        static_prefix.copy_(prefix)
+        graph.replay()
+        return static_loss
+
+    return replay
+
+
 def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
           val_dataset: ClipCocoDataset, myconfig, lr: float = 2e-5,
           warmup_steps: int = 5000, output_dir: str = ".", model_name: str = ""):
@@ -349,49 +443,98 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         os.makedirs(output_dir)
 
     model = model.to(device)
-    optimizer = AdamW(model.parameters(), lr=lr)
+    train_model = model
+    if myconfig.get('compile'):
+        # a separate compiled handle for the loss forwards only , model itself (and its state_dict keys) stays
+        # eager so the kv-cache decode in generate_topk does not recompile for every new past length ;
+        # inductor fuses the mlp bias + tanh into the matmul epilogue
+        train_model = torch.compile(model, mode='reduce-overhead', dynamic=False)
+    # single fused cuda kernel for the whole update , weight_decay=0 as in the transformers AdamW
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.0, fused=True)
     batch_size = myconfig.get('batch_size')
     epochs = myconfig.get('epochs')
-
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
+    accum_steps = myconfig.get('accum_steps', 1)
+    log_every = 50
+
+    num_workers = myconfig.get('num_workers', 0)
+    loader_kwargs = dict(num_workers=num_workers, pin_memory=True, persistent_workers=num_workers > 0,
+                         prefetch_factor=4 if num_workers > 0 else None)
+    if myconfig.get('bucket_by_length'):
+        # per batch padding , batches hold captions of similar length
+        train_dataloader = DataLoader(train_dataset, collate_fn=train_dataset.collate, **loader_kwargs,
+                                      batch_sampler=LengthBucketSampler(train_dataset.lengths, batch_size,
+                                                                        drop_last=True))
+        val_dataloader = DataLoader(val_dataset, collate_fn=val_dataset.collate, **loader_kwargs,
+                                    batch_sampler=LengthBucketSampler(val_dataset.lengths, batch_size))
+    else:
+        # drop_last keeps every train batch the same shape , the captured cuda graphs are replayed without recompiling
+        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, drop_last=True,
+                                      **loader_kwargs)
+        val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False, **loader_kwargs)
 
     # earlystop = EarlyStopping(tolerance=5,delta=0.5)
     scheduler = get_linear_schedule_with_warmup(
-        optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
+        optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * math.ceil(len(train_dataloader) / accum_steps)
     )
     avg_train_loss = []
     avg_val_loss = []
     max_val_loss = float('+inf')
+    # bf16 keeps the fp32 exponent range and needs no loss scaling , the scaler is only active for fp16
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    use_cudagraph = myconfig.get('use_cudagraph', False)
+    if use_cudagraph:
+        # the graph replays one full step with fixed shapes (drop_last) , see capture_train_step
+        assert accum_steps == 1 and not scaler.is_enabled() and not myconfig.get('compile') \
+               and not myconfig.get('bucket_by_length'), \
+            'use_cudagraph needs accum_steps=1, bf16, compile and bucket_by_length disabled'
+    cudagraph_step = None
 
     print('*** Initiate Training Phase *** ')
     print()
     for epoch in range(epochs):
-        progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
-        train_loss = 0
-        for idx, (tokens, mask, prefix) in enumerate(train_dataloader):
+        progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1),
+                        mininterval=0.5)
+        # summed on the device , .item() only when the progress bar is refreshed and at the end of the epoch
+        train_loss = torch.zeros((), device=device)
+        window_loss = torch.zeros((), device=device)
+        for idx, (tokens, mask, prefix) in enumerate(progress):
             model.train()
-            model.zero_grad()
-            tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
-
-            outputs = model(tokens, prefix, mask)
-            logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
-            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
-            train_loss = train_loss + loss.item()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
-            progress.set_postfix({"Batch Train Loss": loss.item()})
-            progress.update()
+            tokens, mask, prefix = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True), \
+                prefix.to(device, non_blocking=True)
+
+            if use_cudagraph:
+                if cudagraph_step is None:
+                    cudagraph_step = capture_train_step(model, tokens, mask, prefix, train_dataset.prefix_length,
+                                                        amp_dtype)
+                loss = cudagraph_step(tokens, mask, prefix)
+            else:
+                with torch.autocast('cuda', dtype=amp_dtype):
+                    outputs = train_model(tokens, prefix, mask)
+                # the loss is taken in fp32 , outside autocast
+                logits = outputs.logits[:, train_dataset.prefix_length - 1: -1].float()
+                loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
+                scaler.scale(loss / accum_steps).backward()
+            train_loss += loss.detach()
+            window_loss += loss.detach()
+            if (idx + 1) % accum_steps == 0 or idx + 1 == len(train_dataloader):
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+                if not use_cudagraph:
+                    optimizer.zero_grad(set_to_none=True)
+            if (idx + 1) % log_every == 0:
+                progress.set_postfix({"Batch Train Loss": (window_loss / log_every).item()})
+                window_loss.zero_()
 
         progress.close()
 
-        epoch_avg_train_loss = train_loss / len(train_dataloader)
+        epoch_avg_train_loss = train_loss.item() / len(train_dataloader)
         avg_train_loss.append(epoch_avg_train_loss)
         print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
 
-        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, prefix_length=val_dataset.prefix_length)
+        epoch_avg_val_loss = apply_validation(train_model, val_dataloader, epoch,
+                                              prefix_length=val_dataset.prefix_length)
         avg_val_loss.append(epoch_avg_val_loss)
 
         # earlystop(epoch_avg_train_loss,epoch_avg_val_loss)
@@ -451,58 +594,55 @@ def generate_topk(
                     tokens = tokens.unsqueeze(0).to(device)
 
                 generated = model.gpt.transformer.wte(tokens)
+            past = None
+            # generated ids are written in place , no torch.cat per step
+            out_tokens = torch.zeros(batch_size, entry_length, dtype=torch.long, device=device)
+            num_generated = 0
             for i in range(entry_length):
-                outputs = model.gpt(inputs_embeds=generated)
+                # after the first step only the newest token is fed , the rest comes from the kv cache
+                outputs = model.gpt(inputs_embeds=generated, past_key_values=past, use_cache=True)
+                past = outputs.past_key_values
                 logits = outputs.logits
                 logits = logits[:, -1, :] / (temperature if temperature > 0 else 1.0)
                 logits = logits.softmax(-1).log()
                 scores, next_tokens = logits.topk(1, -1)
-                if tokens is None:
-                    tokens = next_tokens
-                else:
-                    tokens = torch.cat((tokens, next_tokens), dim=1)
-                next_token_embed = model.gpt.transformer.wte(next_tokens)
-                generated = torch.cat((generated, next_token_embed), dim=1)
+                out_tokens[:, i] = next_tokens.squeeze(1)
+                num_generated = i + 1
+                generated = model.gpt.transformer.wte(next_tokens)
 
-                seq_lengths[~is_stopped] += 1
+                # arithmetic instead of a boolean index , which would run nonzero and sync every step
+                seq_lengths += (~is_stopped).to(seq_lengths.dtype)
                 is_stopped = is_stopped + next_tokens.eq(stop_token_index).squeeze() + \
                              next_tokens.eq(eos_token_index).squeeze()
-                if is_stopped.all():
+                # .all() syncs with the host , check it every 4 steps once a few tokens exist
+                if i >= 5 and i % 4 == 0 and is_stopped.all():
                     break
 
+            out_tokens = out_tokens[:, :num_generated]
+            tokens = out_tokens if tokens is None else torch.cat((tokens, out_tokens), dim=1)
             output_list = tokens.cpu().numpy()
-            output_texts = [
-                tokenizer.decode(output[: int(length)], skip_special_tokens=True)
-                for output, length in zip(output_list, seq_lengths)
-            ]
+            trimmed = [output[: int(length)] for output, length in zip(output_list, seq_lengths.tolist())]
+            # one call into the rust decoder for the whole batch
+            output_texts = tokenizer.batch_decode(trimmed, skip_special_tokens=True)
     return output_texts
 
 
-def merge(list1, list2):
-    assert len(list1) == len(list2)
-    merged_list = [(list1[i], list2[i]) for i in range(0, len(list1))]
-    return merged_list
-
-
 def group_reference_captions(gt_image_ids, gt_captions):
-    mrg = merge(gt_image_ids, gt_captions)
-    temp_dict = {}
-    for key, value in mrg:
-        if key in temp_dict:
-            temp_dict[key].append(value)
-        else:
-            temp_dict[key] = [value]
-    return temp_dict
+    temp_dict = defaultdict(list)
+    for key, value in zip(gt_image_ids, gt_captions):
+        temp_dict[key].append(value)
+    return dict(temp_dict)
 
 
-def validation_generation(model, val_dataset, batch_size, weights_path=None):
+def validation_generation(model, val_dataset, batch_size, weights_path=None, num_workers=4, tokenizer=None):
     start_time = time.time()
     full_gt_dict = {}
     gen = {}
     gts = {}
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
-    tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False,
+                                num_workers=num_workers, pin_memory=True)
+    tokenizer = tokenizer if tokenizer is not None else val_dataset.tokenizer
     generated_captions = []
 
     gt_image_ids = val_dataset.image_ids
@@ -514,7 +654,8 @@ def validation_generation(model, val_dataset, batch_size, weights_path=None):
     model.eval()
 
     for (captions, mask, prefix) in tqdm(val_dataloader, total=len(val_dataloader), desc='Generate Captions'):
-        captions, mask, prefix = captions.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
+        captions, mask, prefix = captions.to(device, non_blocking=True), mask.to(device, non_blocking=True), \
+            prefix.to(device, non_blocking=True).float()
 
         with torch.no_grad():
             prefix_embed = model.clip_project(prefix)
@@ -543,9 +684,19 @@ def validation_generation(model, val_dataset, batch_size, weights_path=None):
 
 
 def main():
+    # tf32 tensor cores for the fp32 matmuls left outside autocast
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     myconfig = {
         'epochs': 10,
         'batch_size': 32,
+        'accum_steps': 1,
+        'num_workers': 4,
+        'compile': True,
+        'use_cudagraph': False,
+        'bucket_by_length': False,
         'train_data': '/scratch/chris.morfopoulos/data/coco/combined_gen_clipscore_80k_feat_train_ic.pkl',
         'val_data': '/scratch/chris.morfopoulos/data/coco/clip_feat_ViT-B_32_val_ic.pkl',
         'out_dir': '/scratch/chris.morfopoulos/temp_code/ablation_/coco_80K',
@@ -557,6 +708,7 @@ def main():
         'num_layers': 8,
         'is_rn': False,
         'normalize_prefix': False,
+        'half_prefix': False,
         'model_name': 'coco_80K',
         'weights_path': '/scratch/chris.morfopoulos/temp_code/ablation_/coco_80K/coco_80K_bestmodel.pt'
 
@@ -564,10 +716,13 @@ def main():
     print('Logging args **** ' + str(myconfig))
     prefix_dim = 640 if myconfig.get('is_rn') else 512
     print()
+    tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
     train_dataset = ClipCocoDataset(myconfig.get('train_data'), myconfig.get('prefix_length'),
-                                    normalize_prefix=myconfig.get('normalize_prefix'))
+                                    normalize_prefix=myconfig.get('normalize_prefix'),
+                                    half_prefix=myconfig.get('half_prefix'), tokenizer=tokenizer)
     val_dataset = ClipCocoDataset(myconfig.get('val_data'), myconfig.get('prefix_length'),
-                                  normalize_prefix=myconfig.get('normalize_prefix'))
+                                  normalize_prefix=myconfig.get('normalize_prefix'),
+                                  half_prefix=myconfig.get('half_prefix'), tokenizer=tokenizer)
     mapping_type = {'mlp': MappingType.MLP, 'transformer': MappingType.Transformer}[myconfig.get('mapping_type')]
     print()
     model = ClipCaptionPrefix(myconfig.get('prefix_length'), clip_length=myconfig.get('prefix_length_clip'),
@@ -576,7 +731,8 @@ def main():
     train(model, train_dataset, val_dataset, myconfig, output_dir=myconfig.get('out_dir'),
           model_name=myconfig.get('model_name'))
 
-    gen, gts, full_gt_dict = validation_generation(model, val_dataset, batch_size=32, weights_path=myconfig.get('weights_path'))
+    gen, gts, full_gt_dict = validation_generation(model, val_dataset, batch_size=32, weights_path=myconfig.get('weights_path'),
+                                                   tokenizer=tokenizer)
 
 
 if __name__ == '__main__':
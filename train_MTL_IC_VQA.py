@@ -3,7 +3,7 @@ import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2TokenizerFast, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
@@ -11,7 +11,7 @@ import sys
 import argparse
 import json
 import numpy as np
-from typing import Tuple, Optional, Union
+from typing import Tuple, Optional, Union, NamedTuple
 import copy
 
 class MappingType(Enum):
@@ -19,36 +19,55 @@ class MappingType(Enum):
     Transformer = 'transformer'
 
 
+class CaptionOutput(NamedTuple):
+    # logits of the text positions only , already shifted by one (prefix_length - 1 : -1)
+    logits: torch.Tensor
+
+
+def token_cache_path(data_path: str) -> str:
+    return os.path.splitext(data_path)[0] + '_tokens.npz'
+
+
+def load_token_cache(data_path: str, gpt2_type: str) -> Optional[dict]:
+    # the cache is only valid for the same .pkl (by mtime) and the same tokenizer
+    cache_path = token_cache_path(data_path)
+    if not os.path.isfile(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if float(cache['mtime']) != os.path.getmtime(data_path) or str(cache['gpt2_type']) != gpt2_type:
+            return None
+        print('loading tokens from ' + cache_path)
+        return {key: cache[key] for key in cache.files}
+
+
+def save_token_cache(data_path: str, gpt2_type: str, **arrays):
+    np.savez(token_cache_path(data_path), mtime=os.path.getmtime(data_path), gpt2_type=gpt2_type, **arrays)
+
+
 class ClipCocoDataset_IC(Dataset):
     def __len__(self) -> int:
-        return len(self.captions_tokens)
+        return len(self.tokens_np)
 
     def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        padding = self.max_seq_len - tokens.shape[0]
+        # tokens and mask are precomputed in __init__ , no per item work and no mutation of the dataset
+        return torch.from_numpy(self.tokens_np[item]), torch.from_numpy(self.mask[item])
+
+    def pad_to_length(self, max_seq_len: int):
+        # zero pad every sample up to a length shared with the other datasets
+        padding = max_seq_len - self.max_seq_len
         if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        mask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~mask] = 0
-        mask = mask.float()
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        return tokens, mask
+            self.tokens_np = np.pad(self.tokens_np, ((0, 0), (0, padding)))
+            self.mask = np.pad(self.mask, ((0, 0), (0, padding)))
+            self.max_seq_len = max_seq_len
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
         tokens, mask = self.pad_tokens(item)
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
         return tokens, mask, prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained(gpt2_type)
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(gpt2_type)
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
@@ -61,79 +80,74 @@ class ClipCocoDataset_IC(Dataset):
         # print('all_data["clip_embedding"]')
         print()
         self.prefixes = all_data["clip_embedding"]
+        if not torch.is_tensor(self.prefixes):
+            # one contiguous (N, prefix_size) tensor , rows are gathered in C
+            self.prefixes = torch.as_tensor(np.stack(self.prefixes), dtype=torch.float32)
+        self.prefixes = self.prefixes.float().contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            self.prefixes = self.prefixes / self.prefixes.norm(2, dim=-1, keepdim=True)
+        # half the memory and host to device bytes , training consumes them under autocast
+        self.prefixes = self.prefixes.half()
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.captions = [caption['caption'] for caption in captions_raw]
-        self.captions_tokens = []
-        self.caption2embedding = []
-        max_seq_len = 0
-        for caption in captions_raw:
-            # tokenize to caption
-            self.captions_tokens.append(torch.tensor(self.tokenizer.encode(caption['caption']), dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-        # self.max_seq_len = max_seq_len
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+        # clip_embedding einai to sequential ID !!
+        self.caption2embedding = torch.tensor([caption["clip_embedding"] for caption in captions_raw],
+                                              dtype=torch.int64)
+        cache = load_token_cache(data_path, gpt2_type)
+        if cache is not None:
+            self.tokens_np, self.captions_len = cache['tokens'], cache['captions_len']
+            self.max_seq_len = int(cache['max_seq_len'])
+        else:
+            # tokenize all the captions in a single call
+            captions_tokens = self.tokenizer(self.captions, add_special_tokens=False)['input_ids']
+            # self.max_seq_len = max_seq_len
+            all_len = np.fromiter((len(tokens) for tokens in captions_tokens), dtype=np.int64,
+                                  count=len(captions_tokens))
+            # ddof=1 , the unbiased std that torch used
+            self.max_seq_len = min(int(all_len.mean() + all_len.std(ddof=1) * 10), int(all_len.max()))
+            self.captions_len = np.minimum(all_len, self.max_seq_len)
+            self.tokens_np = np.zeros((len(captions_tokens), self.max_seq_len), dtype=np.int64)
+            for i, tokens in enumerate(captions_tokens):
+                self.tokens_np[i, :self.captions_len[i]] = tokens[:self.max_seq_len]
+            save_token_cache(data_path, gpt2_type, tokens=self.tokens_np, captions_len=self.captions_len,
+                             max_seq_len=self.max_seq_len)
+        # mask is zero where we out of sequence
+        mask = np.arange(self.max_seq_len) < self.captions_len[:, None]
+        prefix_ones = np.ones((len(self.tokens_np), self.prefix_length), dtype=np.float32)
+        self.mask = np.concatenate((prefix_ones, mask.astype(np.float32)), axis=1)  # adding prefix mask
 
 
 class ClipCocoDataset_VQA(Dataset):
     def __len__(self) -> int:
-        return len(self.captions_tokens)
+        return len(self.tokens_np)
 
     def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        temp_ans = self.answers[item]
-        temp_q = self.questions[item]
-        tokenized_answer = torch.tensor(self.tokenizer.encode(temp_ans), dtype=torch.int64)
-        q_range = len(self.tokenizer.encode(temp_q))
-        a_range = len(self.tokenizer.encode(temp_ans)) + 1
-        rest_range = self.max_seq_len - q_range - a_range
-        if rest_range >= 0:
-            need_pred = q_range * [0] + a_range * [1] + rest_range * [0]
-            need_pred_4gpt = q_range * [1] + a_range * [1] + rest_range * [0]
-        elif rest_range < 0:
-            # TODO
-            # print('SOOS')
-            need_pred = self.max_seq_len * [0]
-            need_pred_4gpt = self.max_seq_len * [0]
-
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        # A boolean tensor that is True where input is greater than or equal to other and False elsewhere
-        # mask = tokens.ge(0)  # mask is zero where we out of sequence
-        # tokens[~mask] = 0
-        mask = torch.FloatTensor(need_pred)
-        mask4gpt = torch.FloatTensor(need_pred_4gpt)
-
-        omask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~omask] = 0
+        # tokens and both masks are precomputed in __init__
+        return torch.from_numpy(self.tokens_np[item]), torch.from_numpy(self.mask[item]), \
+            torch.from_numpy(self.mask4gpt[item])
 
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        mask4gpt = torch.cat((torch.ones(self.prefix_length), mask4gpt), dim=0)  # adding prefix mask
-        return tokens, mask, mask4gpt
+    def pad_to_length(self, max_seq_len: int):
+        # zero pad every sample (and both masks) up to a length shared with the other datasets
+        padding = max_seq_len - self.max_seq_len
+        if padding > 0:
+            self.tokens_np = np.pad(self.tokens_np, ((0, 0), (0, padding)))
+            self.mask = np.pad(self.mask, ((0, 0), (0, padding)))
+            self.mask4gpt = np.pad(self.mask4gpt, ((0, 0), (0, padding)))
+            self.max_seq_len = max_seq_len
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
         tokens, mask, mask4gpt = self.pad_tokens(item)
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
 
         # tokenized caption, mask attention , (prefix --> actual image)
         return tokens, mask, mask4gpt, prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained(gpt2_type)
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(gpt2_type)
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
@@ -141,33 +155,61 @@ class ClipCocoDataset_VQA(Dataset):
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
         self.prefixes = all_data["clip_embedding"]
+        if not torch.is_tensor(self.prefixes):
+            # one contiguous (N, prefix_size) tensor , rows are gathered in C
+            self.prefixes = torch.as_tensor(np.stack(self.prefixes), dtype=torch.float32)
+        self.prefixes = self.prefixes.float().contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            self.prefixes = self.prefixes / self.prefixes.norm(2, dim=-1, keepdim=True)
+        # half the memory and host to device bytes , training consumes them under autocast
+        self.prefixes = self.prefixes.half()
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.answers = [caption['answer'] for caption in captions_raw]
         self.questions = [caption['question'] for caption in captions_raw]
-        ##
-        self.captions_tokens = []
-        self.caption2embedding = []
-        # self.temp_answers_tens = []
-        eos = self.tokenizer.eos_token_id
-        max_seq_len = 0
-        max_ans_len = 0
-        for i, caption in enumerate(captions_raw):
-            # tokenize to caption
-            self.captions_tokens.append(
-                torch.tensor(self.tokenizer.encode(caption['question'] + ' ' + caption['answer']) + [eos],
-                             dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-
-            temp = torch.tensor(self.tokenizer.encode(caption['answer']), dtype=torch.int64)
-            max_ans_len = max(max_ans_len, temp.shape[0])
-
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
-        self.max_ans_len = max_ans_len
+        self.caption2embedding = torch.tensor([caption["clip_embedding"] for caption in captions_raw],
+                                              dtype=torch.int64)
+        cache = load_token_cache(data_path, gpt2_type)
+        if cache is not None:
+            self.tokens_np, self.q_len, self.a_len = cache['tokens'], cache['q_len'], cache['a_len']
+            self.max_seq_len = int(cache['max_seq_len'])
+        else:
+            # tokenize all the questions / answers / q+a sequences in a single call each ,
+            # q_len and a_len replace the two encode() calls that were done in every pad_tokens
+            eos = self.tokenizer.eos_token_id
+            captions_tokens = self.tokenizer([q + ' ' + a for q, a in zip(self.questions, self.answers)],
+                                             add_special_tokens=False)['input_ids']
+            self.q_len = np.array([len(q) for q in self.tokenizer(self.questions, add_special_tokens=False)['input_ids']],
+                                  dtype=np.int64)
+            self.a_len = np.array([len(a) for a in self.tokenizer(self.answers, add_special_tokens=False)['input_ids']],
+                                  dtype=np.int64)
+
+            all_len = np.fromiter((len(tokens) + 1 for tokens in captions_tokens), dtype=np.int64,
+                                  count=len(captions_tokens))
+            # ddof=1 , the unbiased std that torch used
+            self.max_seq_len = min(int(all_len.mean() + all_len.std(ddof=1) * 10), int(all_len.max()))
+            self.tokens_np = np.zeros((len(captions_tokens), self.max_seq_len), dtype=np.int64)
+            for i, tokens in enumerate(captions_tokens):
+                tokens = (tokens + [eos])[:self.max_seq_len]
+                self.tokens_np[i, :len(tokens)] = tokens
+            save_token_cache(data_path, gpt2_type, tokens=self.tokens_np, q_len=self.q_len, a_len=self.a_len,
+                             max_seq_len=self.max_seq_len)
+        self.max_ans_len = int(self.a_len.max())
+
+        # need_pred covers the answer + eos , need_pred_4gpt the question + answer + eos ,
+        # samples that do not fit in max_seq_len are left fully masked
+        positions = np.arange(self.max_seq_len)
+        q_range = self.q_len[:, None]
+        qa_range = q_range + self.a_len[:, None] + 1
+        fits = qa_range <= self.max_seq_len
+        need_pred = (positions >= q_range) & (positions < qa_range) & fits
+        need_pred_4gpt = (positions < qa_range) & fits
+        prefix_ones = np.ones((len(self.tokens_np), self.prefix_length), dtype=np.float32)
+        # SOS
+        self.mask = np.concatenate((prefix_ones, need_pred.astype(np.float32)), axis=1)  # adding prefix mask
+        self.mask4gpt = np.concatenate((prefix_ones, need_pred_4gpt.astype(np.float32)), axis=1)
         print('max_seq_len of whole tokens :  ' + str(self.max_seq_len))
         print('max_ans_len of answers :  ' + str(self.max_ans_len))
 
@@ -217,7 +259,7 @@ class MultiHeadAttention(nn.Module):
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
+    def forward(self, x, y=None, mask=None, need_weights=False):
         y = y if y is not None else x
         b, n, c = x.shape
         _, m, d = y.shape
@@ -226,10 +268,19 @@ class MultiHeadAttention(nn.Module):
         # b m 2 h dh
         keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
         keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient) on b h n dh , the attention matrix is never materialized
+            attn_mask = None if mask is None else ~mask.unsqueeze(1)  # b 1 n m , True where attended
+            out = nnf.scaled_dot_product_attention(queries.transpose(1, 2), keys.transpose(1, 2),
+                                                   values.transpose(1, 2), attn_mask=attn_mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if mask is not None:
             attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
         attention = attention.softmax(dim=2)
         out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
@@ -240,7 +291,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -334,8 +385,11 @@ class ClipCaptionModel(nn.Module):
         embedding_text = self.gpt.transformer.wte(tokens)
         prefix_projections = self.clip_project(prefix).view(-1, self.prefix_length, self.gpt_embedding_size)
         embedding_cat = torch.cat((prefix_projections, embedding_text), dim=1)
-        out = self.gpt(inputs_embeds=embedding_cat, labels=None, attention_mask=mask)
-        return out
+        hidden = self.gpt.transformer(inputs_embeds=embedding_cat, attention_mask=mask).last_hidden_state
+        # lm_head only on the positions that predict the text tokens , the prefix rows never reach
+        # the hidden x vocab matmul
+        logits = self.gpt.lm_head(hidden[:, self.prefix_length - 1: -1])
+        return CaptionOutput(logits=logits)
 
     def __init__(self, prefix_length: int, clip_length: Optional[int] = None, prefix_size: int = 512,
                  num_layers: int = 8, mapping_type: MappingType = MappingType.MLP):
@@ -362,6 +416,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , no weight gradients are computed for it in backward
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -393,15 +453,16 @@ def load_model(config_path: str, epoch_or_latest: Union[str, int] = '_latest'):
     return model, parser
 
 
-def apply_validation_ic(model, val_dataloader, epoch, prefix_length):
+def apply_validation_ic(model, val_dataloader, epoch, prefix_length, amp_dtype=torch.bfloat16):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     val_loss = 0
     model.eval()
     for idx, (tokens, mask, prefix) in enumerate(val_dataloader):
-        tokens, mask, prefix = tokens.to(device), mask.to(device), prefix.to(device, dtype=torch.float32)
-        with torch.no_grad():
+        tokens, mask = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+        prefix = prefix.to(device, non_blocking=True).float()
+        with torch.no_grad(), torch.autocast('cuda', dtype=amp_dtype):
             outputs = model(tokens, prefix, mask)
-            logits = outputs.logits[:, prefix_length - 1: -1]
+            logits = outputs.logits
             loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), tokens.flatten(), ignore_index=0)
             val_loss = val_loss + loss.item()
 
@@ -410,21 +471,22 @@ def apply_validation_ic(model, val_dataloader, epoch, prefix_length):
     return avg_val_loss
 
 
-def apply_validation_vqa(model, val_dataloader, epoch, prefix_length):
+def apply_validation_vqa(model, val_dataloader, epoch, prefix_length, amp_dtype=torch.bfloat16):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     val_loss = 0
     model.eval()
     for idx, (tokens, mask, mask4gpt, prefix) in enumerate(val_dataloader):
-        tokens, mask, mask4gpt, prefix = tokens.to(device), mask.to(device),\
-                                        mask4gpt.to(device), prefix.to(device,dtype=torch.float32)
-        with torch.no_grad():
+        tokens, mask, mask4gpt, prefix = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True),\
+                                        mask4gpt.to(device, non_blocking=True), \
+                                        prefix.to(device, non_blocking=True).float()
+        with torch.no_grad(), torch.autocast('cuda', dtype=amp_dtype):
             outputs = model(tokens, prefix, mask4gpt)
-            logits = outputs.logits[:, prefix_length - 1: -1]
+            logits = outputs.logits
             new_mask = mask[:, 10:]
-            bool_mask = new_mask.ge(1).view(-1)
-            final_logits = logits.reshape(-1, logits.shape[-1])
-            finally_tok = tokens.view(-1)
-            loss = nnf.cross_entropy(final_logits[bool_mask], finally_tok[bool_mask], ignore_index=0)
+            # positions outside the answer (and pad tokens , as ignore_index=0 did) are ignored in place ,
+            # instead of gathering the vocab wide logit rows of the answer
+            finally_tok = tokens.masked_fill(new_mask.lt(1) | tokens.eq(0), -100).view(-1)
+            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), finally_tok, ignore_index=-100)
             val_loss = val_loss + loss.item()
 
     avg_val_loss = val_loss / len(val_dataloader)
@@ -432,31 +494,36 @@ def apply_validation_vqa(model, val_dataloader, epoch, prefix_length):
     return avg_val_loss
 
 
-def train_ic(model, token_ic, mask_ic, prefix_ic):
+def train_ic_vqa(model, token_ic, mask_ic, prefix_ic, tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa):
+    # IC and VQA batches are padded to a common length and go through gpt in a single forward
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     prefix_length = 10
-    tokens, mask, prefix = token_ic.to(device), mask_ic.to(device), prefix_ic.to(device, dtype=torch.float32)
+    # copies straight from the pinned loader batches , padding and concatenation happen on the device
+    token_ic, mask_ic, prefix_ic = token_ic.to(device, non_blocking=True), mask_ic.to(device, non_blocking=True), \
+        prefix_ic.to(device, non_blocking=True)
+    tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa = tokens_vqa.to(device, non_blocking=True), \
+        mask_vqa.to(device, non_blocking=True), mask4gpt_vqa.to(device, non_blocking=True), \
+        prefix_vqa.to(device, non_blocking=True)
+    b_ic = token_ic.shape[0]
+    seq_len = max(token_ic.shape[1], tokens_vqa.shape[1])
+    tokens = torch.cat((nnf.pad(token_ic, (0, seq_len - token_ic.shape[1])),
+                        nnf.pad(tokens_vqa, (0, seq_len - tokens_vqa.shape[1]))), dim=0)
+    mask = torch.cat((nnf.pad(mask_ic, (0, seq_len + prefix_length - mask_ic.shape[1])),
+                      nnf.pad(mask4gpt_vqa, (0, seq_len + prefix_length - mask4gpt_vqa.shape[1]))), dim=0)
+    prefix = torch.cat((prefix_ic, prefix_vqa), dim=0).float()
     outputs = model(tokens, prefix, mask)
-    logits = outputs.logits[:, prefix_length - 1: -1]
-    temp_logits = logits.reshape(-1, logits.shape[-1])
-    temp_tokens = tokens.flatten()
-    return temp_logits , temp_tokens
+    logits = outputs.logits
 
+    temp_logits_ic = logits[:b_ic, :token_ic.shape[1]].reshape(-1, logits.shape[-1])
+    temp_tokens_ic = tokens[:b_ic, :token_ic.shape[1]].flatten()
+
+    tokens, logits = tokens[b_ic:, :tokens_vqa.shape[1]], logits[b_ic:, :tokens_vqa.shape[1]]
+    new_mask = mask_vqa[:, 10:]
+    # -100 outside the answer (and on pad tokens , as ignore_index=0 did) , no gather of the vocab wide logit rows
+    temp_logits_vqa = logits.reshape(-1, logits.shape[-1])
+    temp_tokens_vqa = tokens.masked_fill(new_mask.lt(1) | tokens.eq(0), -100).reshape(-1)
+    return temp_logits_ic, temp_tokens_ic, temp_logits_vqa, temp_tokens_vqa
 
-def train_vqa(model, tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa):
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    prefix_length = 10
-    tokens, mask, mask4gpt, prefix = tokens_vqa.to(device), mask_vqa.to(device), mask4gpt_vqa.to(device), \
-        prefix_vqa.to(device, dtype=torch.float32)
-    outputs = model(tokens, prefix, mask4gpt)
-    logits = outputs.logits[:, prefix_length - 1: -1]
-    new_mask = mask[:, 10:]
-    bool_mask = new_mask.ge(1).view(-1)
-    final_logits = logits.reshape(-1, logits.shape[-1])
-    finally_tok = tokens.view(-1)
-    temp_logits = final_logits[bool_mask]
-    temp_tokens = finally_tok[bool_mask]
-    return temp_logits , temp_tokens
 
 def main():
     myconfig = {
@@ -478,7 +545,9 @@ def main():
         'is_rn': False,
         'normalize_prefix': False,
         'model_name': 'MTL_diffu_model_vizwiz',
-        'weights_path': ''
+        'weights_path': '',
+        'compile': True,
+        'num_workers': 4
 
     }
     print('Logging args **** ' + str(myconfig))
@@ -508,15 +577,22 @@ def main():
                                           myconfig.get('prefix_length'),
                                           normalize_prefix=myconfig.get('normalize_prefix'))
 
-    train_dataloader_ic = DataLoader(train_dataset_ic, batch_size=myconfig.get('batch_size'), shuffle=False,
-                                     drop_last=False)
-    val_dataloader_ic = DataLoader(val_dataset_ic, batch_size=myconfig.get('batch_size'), shuffle=False,
-                                   drop_last=False)
+    # one sequence length for all four datasets , the compiled model then only sees a fixed set of
+    # static shapes (the fused train batch and the full / last validation batches)
+    max_seq_len = max(dataset.max_seq_len for dataset in (train_dataset_ic, val_dataset_ic,
+                                                          train_dataset_vqa, val_dataset_vqa))
+    for dataset in (train_dataset_ic, val_dataset_ic, train_dataset_vqa, val_dataset_vqa):
+        dataset.pad_to_length(max_seq_len)
 
-    train_dataloader_vqa = DataLoader(train_dataset_vqa, batch_size=myconfig.get('batch_size'), shuffle=False,
-                                      drop_last=False)
-    val_dataloader_vqa = DataLoader(val_dataset_vqa, batch_size=myconfig.get('batch_size'), shuffle=False,
-                                    drop_last=False)
+    num_workers = myconfig.get('num_workers', 0)
+    loader_kwargs = dict(batch_size=myconfig.get('batch_size'), shuffle=False, num_workers=num_workers,
+                         pin_memory=True, persistent_workers=num_workers > 0,
+                         prefetch_factor=4 if num_workers > 0 else None)
+    train_dataloader_ic = DataLoader(train_dataset_ic, drop_last=True, **loader_kwargs)
+    val_dataloader_ic = DataLoader(val_dataset_ic, drop_last=False, **loader_kwargs)
+
+    train_dataloader_vqa = DataLoader(train_dataset_vqa, drop_last=True, **loader_kwargs)
+    val_dataloader_vqa = DataLoader(val_dataset_vqa, drop_last=False, **loader_kwargs)
 
     print('*** Lengths ***')
     print(len(train_dataset_ic))
@@ -531,8 +607,6 @@ def main():
 
     counter_batch_ic = 0
     counter_batch_vqa = 0
-    train_loss_ic = 0
-    train_loss_vqa = 0
     lr = 2e-5
     warmup_steps = 5000
     epochs = myconfig.get('epochs')
@@ -541,8 +615,24 @@ def main():
         os.makedirs(output_dir)
 
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # accumulated on the device , read back once per epoch instead of two .item() syncs per step
+    train_loss_ic = torch.zeros((), device=device)
+    train_loss_vqa = torch.zeros((), device=device)
+    log_every = 50
     model = model.to(device)
-    optimizer = AdamW(model.parameters(), lr=lr)
+    if myconfig.get('compile'):
+        # in-place, so the saved state_dict keys stay the same ; the fused IC + VQA train batch has the
+        # same shape every step
+        model.compile(mode='reduce-overhead', dynamic=False)
+    elif mapping_type == MappingType.MLP:
+        # without inductor , let the torchscript fuser merge the bias add + tanh of the wide mapper ,
+        # the state_dict keys are unchanged
+        model.clip_project = torch.jit.script(model.clip_project)
+    # single fused cuda kernel for the whole update , weight_decay=0 as in the transformers AdamW
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=0.0, fused=True)
+    # bf16 keeps the fp32 exponent range and needs no loss scaling , the scaler is only active for fp16
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=warmup_steps,
         num_training_steps=epochs * len(train_dataloader_vqa))
@@ -553,7 +643,7 @@ def main():
         progress = tqdm(train_dataloader_ic, total=len(train_dataloader_ic), desc='Epoch [{}/{}]'.format(epoch,epochs-1))
         while True:
             model.train()
-            model.zero_grad()
+            model.zero_grad(set_to_none=True)
             try:
                 batch_ic = next(t_ic_dataloader)
                 batch_vqa = next(t_vqa_dataloader)
@@ -562,33 +652,35 @@ def main():
 
             (token_ic, mask_ic, prefix_ic) = batch_ic
             (tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa) = batch_vqa
-            temp_logits_ic, temp_tokens_ic = train_ic(model, token_ic, mask_ic, prefix_ic)
-            temp_logits_vqa, temp_tokens_vqa = train_vqa(model, tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa)
-
             weight_ic = myconfig.get('weight_loss_ic')
             weight_vqa = myconfig.get('weight_loss_vqa')
 
-            loss_ic = nnf.cross_entropy(temp_logits_ic, temp_tokens_ic, ignore_index = 0)
-            loss_vqa = nnf.cross_entropy(temp_logits_vqa, temp_tokens_vqa, ignore_index = 0)
-            loss = (weight_ic * loss_ic) + (weight_vqa * loss_vqa)
+            with torch.autocast('cuda', dtype=amp_dtype):
+                temp_logits_ic, temp_tokens_ic, temp_logits_vqa, temp_tokens_vqa = \
+                    train_ic_vqa(model, token_ic, mask_ic, prefix_ic, tokens_vqa, mask_vqa, mask4gpt_vqa, prefix_vqa)
+
+                loss_ic = nnf.cross_entropy(temp_logits_ic, temp_tokens_ic, ignore_index = 0)
+                loss_vqa = nnf.cross_entropy(temp_logits_vqa, temp_tokens_vqa, ignore_index = -100)
+                loss = (weight_ic * loss_ic) + (weight_vqa * loss_vqa)
 
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             scheduler.step()
-            optimizer.zero_grad()
 
-            train_loss_ic = train_loss_ic + loss_ic.item()
-            train_loss_vqa = train_loss_vqa + loss_vqa.item()
+            train_loss_ic += loss_ic.detach()
+            train_loss_vqa += loss_vqa.detach()
 
             counter_batch_ic += mask_ic.shape[0]
             counter_batch_vqa += mask_vqa.shape[0]
-            progress.set_postfix({"Batch train_loss_ic": loss_ic.item(),
-                                  "Batch train_loss_vqa": loss_vqa.item()})
+            if progress.n % log_every == 0:
+                progress.set_postfix({"Batch train_loss_ic": loss_ic.item(),
+                                      "Batch train_loss_vqa": loss_vqa.item()})
             progress.update()
 
         progress.close()
-        epoch_avg_train_loss_ic = train_loss_ic / len(train_dataloader_ic)
-        epoch_avg_train_loss_vqa = train_loss_vqa / len(train_dataloader_ic)
+        epoch_avg_train_loss_ic = train_loss_ic.item() / len(train_dataloader_ic)
+        epoch_avg_train_loss_vqa = train_loss_vqa.item() / len(train_dataloader_ic)
 
         avg_train_loss_ic.append(epoch_avg_train_loss_ic)
         avg_train_loss_vqa.append(epoch_avg_train_loss_vqa)
@@ -598,8 +690,10 @@ def main():
         print('Trained for total of {} samples in Visual Question Answering (VQA).'.format(counter_batch_vqa))
         print()
 
-        epoch_avg_val_loss_ic = apply_validation_ic(model, val_dataloader_ic, epoch, prefix_length=10)
-        epoch_avg_val_loss_vqa = apply_validation_vqa(model, val_dataloader_vqa, epoch, prefix_length=10)
+        epoch_avg_val_loss_ic = apply_validation_ic(model, val_dataloader_ic, epoch, prefix_length=10,
+                                                    amp_dtype=amp_dtype)
+        epoch_avg_val_loss_vqa = apply_validation_vqa(model, val_dataloader_vqa, epoch, prefix_length=10,
+                                                      amp_dtype=amp_dtype)
 
         avg_val_loss_ic.append(epoch_avg_val_loss_ic)
         avg_val_loss_vqa.append(epoch_avg_val_loss_vqa)
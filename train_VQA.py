@@ -2,14 +2,17 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as nnf
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
 from enum import Enum
-from transformers import GPT2Tokenizer, GPT2LMHeadModel, AdamW, get_linear_schedule_with_warmup
+from transformers import GPT2Tokenizer, GPT2TokenizerFast, GPT2LMHeadModel, get_linear_schedule_with_warmup
 from tqdm import tqdm
 import os
 import pickle
 import sys
 import argparse
 import json
+import gc
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from typing import Tuple, Optional, Union
 import copy
@@ -20,62 +23,45 @@ class MappingType(Enum):
     Transformer = 'transformer'
 
 
+def token_cache_path(data_path: str) -> str:
+    return os.path.splitext(data_path)[0] + '_tokens.npz'
+
+
+def load_token_cache(data_path: str, gpt2_type: str) -> Optional[dict]:
+    # the cache is only valid for the same .pkl (by mtime) and the same tokenizer
+    cache_path = token_cache_path(data_path)
+    if not os.path.isfile(cache_path):
+        return None
+    with np.load(cache_path) as cache:
+        if float(cache['mtime']) != os.path.getmtime(data_path) or str(cache['gpt2_type']) != gpt2_type:
+            return None
+        print('loading tokens from ' + cache_path)
+        return {key: cache[key] for key in cache.files}
+
+
+def save_token_cache(data_path: str, gpt2_type: str, **arrays):
+    np.savez(token_cache_path(data_path), mtime=os.path.getmtime(data_path), gpt2_type=gpt2_type, **arrays)
+
+
 class ClipCocoDataset(Dataset):
 
     def __len__(self) -> int:
-        return len(self.captions_tokens)
+        return len(self.tokens)
 
     def pad_tokens(self, item: int):
-        tokens = self.captions_tokens[item]
-        temp_ans = self.answers[item]
-        temp_q = self.questions[item]
-        tokenized_answer = torch.tensor(self.tokenizer.encode(temp_ans), dtype=torch.int64)
-        q_range = len(self.tokenizer.encode(temp_q))
-        a_range = len(self.tokenizer.encode(temp_ans)) + 1
-        rest_range = self.max_seq_len - q_range - a_range
-        if rest_range >= 0:
-            need_pred = q_range * [0] + a_range * [1] + rest_range * [0]
-            need_pred_4gpt = q_range * [1] + a_range * [1] + rest_range * [0]
-        elif rest_range < 0:
-            # TODO
-            # print('SOOS')
-            need_pred = self.max_seq_len * [0]
-            need_pred_4gpt = self.max_seq_len * [0]
-
-        padding = self.max_seq_len - tokens.shape[0]
-        if padding > 0:
-            tokens = torch.cat((tokens, torch.zeros(padding, dtype=torch.int64) - 1))
-            self.captions_tokens[item] = tokens
-        elif padding < 0:
-            tokens = tokens[:self.max_seq_len]
-            self.captions_tokens[item] = tokens
-        # A boolean tensor that is True where input is greater than or equal to other and False elsewhere
-        # mask = tokens.ge(0)  # mask is zero where we out of sequence
-        # tokens[~mask] = 0
-        mask = torch.FloatTensor(need_pred)
-        mask4gpt = torch.FloatTensor(need_pred_4gpt)
-
-        omask = tokens.ge(0)  # mask is zero where we out of sequence
-        tokens[~omask] = 0
-
-        # SOS
-        mask = torch.cat((torch.ones(self.prefix_length), mask), dim=0)  # adding prefix mask
-        mask4gpt = torch.cat((torch.ones(self.prefix_length), mask4gpt), dim=0)  # adding prefix mask
-        return tokens, mask, mask4gpt
+        # tokens and both masks are precomputed in __init__
+        return self.tokens[item], self.mask[item], self.mask4gpt[item]
 
     def __getitem__(self, item: int) -> Tuple[torch.Tensor, ...]:
         tokens, mask, mask4gpt = self.pad_tokens(item)
         prefix = self.prefixes[self.caption2embedding[item]]
-        if self.normalize_prefix:
-            prefix = prefix.float()
-            prefix = prefix / prefix.norm(2, -1)
 
         # tokenized caption, mask attention , (prefix --> actual image)
         return tokens, mask, mask4gpt, prefix
 
     def __init__(self, data_path: str, prefix_length: int, gpt2_type: str = "gpt2",
                  normalize_prefix=False):
-        self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2-xl')
+        self.tokenizer = GPT2TokenizerFast.from_pretrained('gpt2-xl')
         self.prefix_length = prefix_length
         self.normalize_prefix = normalize_prefix
         with open(data_path, 'rb') as f:
@@ -83,33 +69,61 @@ class ClipCocoDataset(Dataset):
         print("Data size is %0d" % len(all_data["clip_embedding"]))
         sys.stdout.flush()
         self.prefixes = all_data["clip_embedding"]
+        if not torch.is_tensor(self.prefixes):
+            # one contiguous (N, prefix_size) tensor , rows are gathered in C
+            self.prefixes = torch.stack([torch.as_tensor(prefix) for prefix in self.prefixes])
+        self.prefixes = self.prefixes.float().contiguous()
+        if self.normalize_prefix:
+            # normalized once here , per row (keepdim) instead of per item
+            self.prefixes = self.prefixes / self.prefixes.norm(2, dim=-1, keepdim=True)
         captions_raw = all_data["captions"]
         # image ids kai captions
         self.image_ids = [caption["image_id"] for caption in captions_raw]
         self.answers = [caption['answer'] for caption in captions_raw]
         self.questions = [caption['question'] for caption in captions_raw]
-        ##
-        self.captions_tokens = []
-        self.caption2embedding = []
-        # self.temp_answers_tens = []
-        eos = self.tokenizer.eos_token_id
-        max_seq_len = 0
-        max_ans_len = 0
-        for i, caption in enumerate(captions_raw):
-            # tokenize to caption
-            self.captions_tokens.append(
-                torch.tensor(self.tokenizer.encode(caption['question'] + ' ' + caption['answer']) + [eos],
-                             dtype=torch.int64))
-            # clip_embedding einai to sequential ID !!
-            self.caption2embedding.append(caption["clip_embedding"])
-            max_seq_len = max(max_seq_len, self.captions_tokens[-1].shape[0])
-
-            temp = torch.tensor(self.tokenizer.encode(caption['answer']), dtype=torch.int64)
-            max_ans_len = max(max_ans_len, temp.shape[0])
-
-        all_len = torch.tensor([len(self.captions_tokens[i]) for i in range(len(self))]).float()
-        self.max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
-        self.max_ans_len = max_ans_len
+        # clip_embedding einai to sequential ID !!
+        self.caption2embedding = [caption["clip_embedding"] for caption in captions_raw]
+        # keyed on the tokenizer actually loaded above , same arrays as the train_MTL_IC_VQA VQA cache
+        tokenizer_type = self.tokenizer.name_or_path
+        cache = load_token_cache(data_path, tokenizer_type)
+        if cache is not None:
+            self.tokens = torch.from_numpy(cache['tokens'])
+            self.q_len, self.a_len = torch.from_numpy(cache['q_len']), torch.from_numpy(cache['a_len'])
+        else:
+            # tokenize all the q+a sequences / questions / answers in a single call each of the fast (rust)
+            # tokenizer , q_len and a_len replace the two encode() calls that were done in every pad_tokens
+            eos = self.tokenizer.eos_token_id
+            captions_tokens = self.tokenizer([q + ' ' + a for q, a in zip(self.questions, self.answers)],
+                                             add_special_tokens=False)['input_ids']
+            captions_tokens = [torch.tensor(tokens + [eos], dtype=torch.int64) for tokens in captions_tokens]
+            self.q_len = torch.tensor(self.tokenizer(self.questions, add_special_tokens=False,
+                                                     return_length=True)['length'], dtype=torch.int64)
+            self.a_len = torch.tensor(self.tokenizer(self.answers, add_special_tokens=False,
+                                                     return_length=True)['length'], dtype=torch.int64)
+
+            all_len = torch.tensor([len(tokens) for tokens in captions_tokens]).float()
+            max_seq_len = min(int(all_len.mean() + all_len.std() * 10), int(all_len.max()))
+            # zero padded (and truncated) tokens , built once in a single pad_sequence instead of in every pad_tokens
+            self.tokens = pad_sequence(captions_tokens, batch_first=True, padding_value=0)[:, :max_seq_len]
+            self.tokens = self.tokens.contiguous()
+            save_token_cache(data_path, tokenizer_type, tokens=self.tokens.numpy(), q_len=self.q_len.numpy(),
+                             a_len=self.a_len.numpy(), max_seq_len=max_seq_len)
+        self.max_seq_len = self.tokens.shape[1]
+        self.max_ans_len = int(self.a_len.max())
+
+        # need_pred covers the answer + eos , need_pred_4gpt the question + answer + eos ,
+        # samples that do not fit in max_seq_len are left fully masked
+        positions = torch.arange(self.max_seq_len)
+        q_range = self.q_len.unsqueeze(1)
+        qa_range = q_range + self.a_len.unsqueeze(1) + 1
+        fits = qa_range <= self.max_seq_len
+        need_pred = (positions >= q_range) & (positions < qa_range) & fits
+        need_pred_4gpt = (positions < qa_range) & fits
+        prefix_ones = torch.ones(len(self.tokens), self.prefix_length)
+        # bool answer mask without the prefix part , the loss positions are selected with it directly
+        self.mask = need_pred
+        # SOS
+        self.mask4gpt = torch.cat((prefix_ones, need_pred_4gpt.float()), dim=1)  # adding prefix mask
         print('max_seq_len of whole tokens :  ' + str(self.max_seq_len))
         print('max_ans_len of answers :  ' + str(self.max_ans_len))
 
@@ -154,24 +168,67 @@ class MultiHeadAttention(nn.Module):
         self.num_heads = num_heads
         head_dim = dim_self // num_heads
         self.scale = head_dim ** -0.5
-        self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
-        self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
+        self.fused_qkv = dim_ref == dim_self
+        if self.fused_qkv:
+            # one gemm for queries , keys and values , the state_dict keeps the to_queries / to_keys_values
+            # layout so checkpoints stay interchangeable with the other scripts
+            self.to_qkv = nn.Linear(dim_self, dim_self * 3, bias=bias)
+            self._register_state_dict_hook(MultiHeadAttention._split_qkv)
+            self._register_load_state_dict_pre_hook(MultiHeadAttention._merge_qkv)
+        else:
+            self.to_queries = nn.Linear(dim_self, dim_self, bias=bias)
+            self.to_keys_values = nn.Linear(dim_ref, dim_self * 2, bias=bias)
         self.project = nn.Linear(dim_self, dim_self)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x, y=None, mask=None):
-        y = y if y is not None else x
+    @staticmethod
+    def _split_qkv(module, state_dict, prefix, local_metadata):
+        dim_self = module.to_qkv.out_features // 3
+        for name in ('weight', 'bias'):
+            qkv = state_dict.pop(prefix + 'to_qkv.' + name, None)
+            if qkv is not None:
+                state_dict[prefix + 'to_queries.' + name] = qkv[:dim_self]
+                state_dict[prefix + 'to_keys_values.' + name] = qkv[dim_self:]
+
+    @staticmethod
+    def _merge_qkv(state_dict, prefix, *args):
+        for name in ('weight', 'bias'):
+            q_key, kv_key = prefix + 'to_queries.' + name, prefix + 'to_keys_values.' + name
+            if q_key in state_dict and kv_key in state_dict:
+                state_dict[prefix + 'to_qkv.' + name] = torch.cat((state_dict.pop(q_key), state_dict.pop(kv_key)))
+
+    def forward(self, x, y=None, mask=None, need_weights=False):
         b, n, c = x.shape
-        _, m, d = y.shape
-        # b n h dh
-        queries = self.to_queries(x).reshape(b, n, self.num_heads, c // self.num_heads)
-        # b m 2 h dh
-        keys_values = self.to_keys_values(y).reshape(b, m, 2, self.num_heads, c // self.num_heads)
-        keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
-        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if self.fused_qkv and (y is None or y is x):
+            # b n 3 h dh
+            queries, keys, values = self.to_qkv(x).reshape(b, n, 3, self.num_heads, c // self.num_heads).unbind(2)
+        else:
+            y = y if y is not None else x
+            _, m, d = y.shape
+            if self.fused_qkv:
+                bias = self.to_qkv.bias
+                queries = nnf.linear(x, self.to_qkv.weight[:c], None if bias is None else bias[:c])
+                keys_values = nnf.linear(y, self.to_qkv.weight[c:], None if bias is None else bias[c:])
+            else:
+                queries, keys_values = self.to_queries(x), self.to_keys_values(y)
+            # b n h dh
+            queries = queries.reshape(b, n, self.num_heads, c // self.num_heads)
+            # b m 2 h dh
+            keys_values = keys_values.reshape(b, m, 2, self.num_heads, c // self.num_heads)
+            keys, values = keys_values[:, :, 0], keys_values[:, :, 1]
         if mask is not None:
             if mask.dim() == 2:
                 mask = mask.unsqueeze(1)
+        if not need_weights:
+            # fused kernel (flash / mem-efficient) on b h n dh , the attention matrix is never materialized
+            attn_mask = None if mask is None else ~mask.unsqueeze(1)  # b 1 n m , True where attended
+            out = nnf.scaled_dot_product_attention(queries.transpose(1, 2), keys.transpose(1, 2),
+                                                   values.transpose(1, 2), attn_mask=attn_mask,
+                                                   dropout_p=self.dropout.p if self.training else 0.)
+            out = self.project(out.transpose(1, 2).reshape(b, n, c))
+            return out, None
+        attention = torch.einsum('bnhd,bmhd->bnmh', queries, keys) * self.scale
+        if mask is not None:
             attention = attention.masked_fill(mask.unsqueeze(3), float("-inf"))
         attention = attention.softmax(dim=2)
         out = torch.einsum('bnmh,bmhd->bnhd', attention, values).reshape(b, n, c)
@@ -182,7 +239,7 @@ class MultiHeadAttention(nn.Module):
 class TransformerLayer(nn.Module):
 
     def forward_with_attention(self, x, y=None, mask=None):
-        x_, attention = self.attn(self.norm1(x), y, mask)
+        x_, attention = self.attn(self.norm1(x), y, mask, need_weights=True)
         x = x + x_
         x = x + self.mlp(self.norm2(x))
         return x, attention
@@ -316,6 +373,12 @@ class ClipCaptionPrefix(ClipCaptionModel):
         self.gpt.eval()
         return self
 
+    def __init__(self, *args, **kwargs):
+        super(ClipCaptionPrefix, self).__init__(*args, **kwargs)
+        # frozen gpt , no weight gradients are computed for it in backward
+        for p in self.gpt.parameters():
+            p.requires_grad_(False)
+
 
 def save_config(args: argparse.Namespace):
     config = {}
@@ -347,21 +410,19 @@ def load_model(config_path: str, epoch_or_latest: Union[str, int] = '_latest'):
     return model, parser
 
 
-def apply_validation(model, val_dataloader, epoch, prefix_length):
+def apply_validation(model, val_dataloader, epoch, prefix_length, amp_dtype=torch.bfloat16):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     val_loss = 0
     model.eval()
     for idx, (tokens, mask, mask4gpt, prefix) in enumerate(val_dataloader):
-        tokens, mask, mask4gpt, prefix = tokens.to(device), mask.to(device), mask4gpt.to(device), prefix.to(device,
-                                                                                                            dtype=torch.float32)
-        with torch.no_grad():
+        tokens, mask = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+        mask4gpt, prefix = mask4gpt.to(device, non_blocking=True), prefix.to(device, non_blocking=True)
+        with torch.no_grad(), torch.autocast('cuda', dtype=amp_dtype):
             outputs = model(tokens, prefix, mask4gpt)
             logits = outputs.logits[:, prefix_length - 1: -1]
-            new_mask = mask[:, 10:]
-            bool_mask = new_mask.ge(1).view(-1)
-            final_logits = logits.reshape(-1, logits.shape[-1])
-            finally_tok = tokens.view(-1)
-            loss = nnf.cross_entropy(final_logits[bool_mask], finally_tok[bool_mask], ignore_index=0)
+            # -100 outside the answer (and on pad tokens , as ignore_index=0 did) , no gather of the logit rows
+            labels = tokens.masked_fill(~mask | tokens.eq(0), -100)
+            loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.view(-1), ignore_index=-100)
             val_loss = val_loss + loss.item()
 
     avg_val_loss = val_loss / len(val_dataloader)
@@ -445,12 +506,11 @@ def validation_generation(model, val_dataset, weights_path=None):
                                                    desc='Generate Captions/Answers'):
         captions, mask, mask4gpt, prefix = captions.to(device), mask.to(device), mask4gpt.to(device), prefix.to(device,
                                                                                                                 dtype=torch.float32)
-        temp_question_mask = torch.logical_xor(mask[:, 10:], mask4gpt[:, 10:]).float()
+        temp_question_mask = torch.logical_xor(mask, mask4gpt[:, 10:]).float()
         masky = torch.cat((torch.ones((batch_size, 10),dtype=torch.float),temp_question_mask), dim=1)
 
-        new_mask = mask[:, 10:].ge(1)
         new_mask4gpt = mask4gpt[:, 10:].ge(1)
-        question_mask = torch.logical_xor(new_mask, new_mask4gpt)
+        question_mask = torch.logical_xor(mask, new_mask4gpt)
         questions = captions * question_mask
 
         # for b in range(batch_size):
@@ -490,70 +550,102 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
         os.makedirs(output_dir)
 
     model = model.to(device)
-    optimizer = AdamW(model.parameters(), lr=lr)
+    if myconfig.get('compile'):
+        # in-place, so the saved state_dict keys stay the same ; the dataset pads every sample to max_seq_len
+        # so the shapes are static
+        model.compile(mode='reduce-overhead', dynamic=False)
+    elif isinstance(model.clip_project, MLP):
+        # without inductor , let the torchscript fuser merge the bias add + tanh of the wide mapper ,
+        # the state_dict keys are unchanged
+        model.clip_project = torch.jit.script(model.clip_project)
+    # single fused cuda kernel for the whole update over the trainable (mapping) params only ,
+    # weight_decay=0 as in the transformers AdamW
+    optimizer = torch.optim.AdamW(filter(lambda p: p.requires_grad, model.parameters()), lr=lr, weight_decay=0.0,
+                                  fused=True)
     batch_size = myconfig.get('batch_size')
     epochs = myconfig.get('epochs')
 
-    train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
-    val_dataloader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, drop_last=False)
+    # batches are built in worker processes and copied from pinned memory while the gpu is busy
+    num_workers = myconfig.get('num_workers', 0)
+    loader_kwargs = dict(batch_size=batch_size, shuffle=False, drop_last=False, num_workers=num_workers,
+                         pin_memory=True, persistent_workers=num_workers > 0,
+                         prefetch_factor=2 if num_workers > 0 else None)
+    train_dataloader = DataLoader(train_dataset, **loader_kwargs)
+    val_dataloader = DataLoader(val_dataset, **loader_kwargs)
 
     scheduler = get_linear_schedule_with_warmup(
         optimizer, num_warmup_steps=warmup_steps, num_training_steps=epochs * len(train_dataloader)
     )
+    # bf16 needs no loss scaling , the scaler only kicks in on fp16-only gpus
+    amp_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
     avg_train_loss = []
     avg_val_loss = []
     max_val_loss = float('+inf')
-
-    print('*** Initiate Training Phase *** ')
-    print()
-    for epoch in range(epochs):
-        progress = tqdm(train_dataloader, total=len(train_dataloader), desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
-        train_loss = 0
-        for idx, (tokens, mask, mask4gpt, prefix) in enumerate(train_dataloader):
-            model.train()
-            model.zero_grad()
-            tokens, mask, mask4gpt, prefix = tokens.to(device), mask.to(device), mask4gpt.to(device), prefix.to(device,
-                                                                                                                dtype=torch.float32)
-
-            outputs = model(tokens, prefix, mask4gpt)
-            logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
-            new_mask = mask[:, 10:]
-            bool_mask = new_mask.ge(1).view(-1)
-            final_logits = logits.reshape(-1, logits.shape[-1])
-            finally_tok = tokens.view(-1)
-
-            loss = nnf.cross_entropy(final_logits[bool_mask], finally_tok[bool_mask], ignore_index=0)
-            train_loss = train_loss + loss.item()
-            loss.backward()
-            optimizer.step()
-            scheduler.step()
-            optimizer.zero_grad()
-            progress.set_postfix({"Batch Train Loss": loss.item()})
-            progress.update()
-
-        progress.close()
-
-        epoch_avg_train_loss = train_loss / len(train_dataloader)
-        avg_train_loss.append(epoch_avg_train_loss)
-        print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
-
-        epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, prefix_length=val_dataset.prefix_length)
-        avg_val_loss.append(epoch_avg_val_loss)
-
-
-        if epoch_avg_val_loss < max_val_loss:
-            # best_model = copy.deepcopy(model)
-            max_val_loss = epoch_avg_val_loss
-
-            # torch.save(best_model.state_dict(), os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
-            print(f'Best Validation loss  : {epoch_avg_val_loss}')
-
-        if epoch % myconfig.get('save_every') == 0 or epoch == epochs - 1:
-            torch.save(
-                model.state_dict(),
-                os.path.join(output_dir, f"{model_name}-{epoch:03d}.pt"),
-            )
-
+    # the losses are summed on the device , the host only syncs every log_every steps for the progress bar
+    log_every = 50
+
+    # checkpoints are serialized and written by a background thread , the loop only waits for the cpu snapshot
+    saver = ThreadPoolExecutor(max_workers=1)
+    # no full gc pauses in the middle of the epoch , collected by hand every 50 steps
+    gc.disable()
+    try:
+        print('*** Initiate Training Phase *** ')
+        print()
+        for epoch in range(epochs):
+            progress = tqdm(train_dataloader, total=len(train_dataloader),
+                            desc='Epoch [{}/{}]'.format(epoch, epochs - 1))
+            train_loss = torch.zeros((), device=device)
+            for idx, (tokens, mask, mask4gpt, prefix) in enumerate(train_dataloader):
+                model.train()
+                tokens, mask = tokens.to(device, non_blocking=True), mask.to(device, non_blocking=True)
+                mask4gpt, prefix = mask4gpt.to(device, non_blocking=True), prefix.to(device, non_blocking=True)
+
+                with torch.autocast('cuda', dtype=amp_dtype):
+                    outputs = model(tokens, prefix, mask4gpt)
+                    logits = outputs.logits[:, train_dataset.prefix_length - 1: -1]
+                    # -100 outside the answer (and on pad tokens , as ignore_index=0 did) , the loss has a static shape
+                    # and selecting the answer rows no longer syncs with the host
+                    labels = tokens.masked_fill(~mask | tokens.eq(0), -100)
+                    loss = nnf.cross_entropy(logits.reshape(-1, logits.shape[-1]), labels.view(-1), ignore_index=-100)
+                train_loss += loss.detach()
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                scheduler.step()
+                optimizer.zero_grad(set_to_none=True)
+                if idx % 50 == 0:
+                    # young generation only , the automatic collector is off during training
+                    gc.collect(1)
+                if progress.n % log_every == 0:
+                    progress.set_postfix({"Batch Train Loss": loss.item()})
+                progress.update()
+
+            progress.close()
+
+            epoch_avg_train_loss = train_loss.item() / len(train_dataloader)
+            avg_train_loss.append(epoch_avg_train_loss)
+            print('*** In Epoch {} the average train loss : {} ***'.format(epoch, epoch_avg_train_loss))
+
+            epoch_avg_val_loss = apply_validation(model, val_dataloader, epoch, prefix_length=val_dataset.prefix_length,
+                                                  amp_dtype=amp_dtype)
+            avg_val_loss.append(epoch_avg_val_loss)
+
+
+            if epoch_avg_val_loss < max_val_loss:
+                # best_model = copy.deepcopy(model)
+                max_val_loss = epoch_avg_val_loss
+
+                # torch.save(best_model.state_dict(), os.path.join(output_dir, f"{model_name}_bestmodel.pt"))
+                print(f'Best Validation loss  : {epoch_avg_val_loss}')
+
+            if epoch % myconfig.get('save_every') == 0 or epoch == epochs - 1:
+                state = {k: v.detach().cpu() for k, v in model.state_dict().items()}
+                saver.submit(torch.save, state, os.path.join(output_dir, f"{model_name}-{epoch:03d}.pt"))
+    finally:
+        # also on an exception (or ctrl-c) , the collector must not stay disabled
+        saver.shutdown(wait=True)
+        gc.enable()
     print()
     print('####')
     print(avg_train_loss)
@@ -567,6 +659,11 @@ def train(model: ClipCaptionModel, train_dataset: ClipCocoDataset,
 
 
 def main():
+    # tf32 tensor cores for the fp32 matmuls
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.set_float32_matmul_precision('high')
+
     myconfig = {
         'epochs': 10,
         'batch_size': 8,
@@ -582,7 +679,9 @@ def main():
         'is_rn': False,
         'normalize_prefix': False,
         'model_name': 'vizwiz_vqa_model_xl',
-        'weights_path': './vizwiz_VQA_xl/vizwiz_vqa_model_xl_bestmodel.pt'
+        'weights_path': './vizwiz_VQA_xl/vizwiz_vqa_model_xl_bestmodel.pt',
+        'compile': True,
+        'num_workers': 4
 
     }
     print('Logging args **** ' + str(myconfig))